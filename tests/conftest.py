@@ -0,0 +1,55 @@
+import json
+import os
+import pathlib
+import typing
+
+import pytest
+
+import zilch.api
+
+tests = pathlib.Path(__file__).parent
+
+# Filled in by the bench_report fixture, printed at the end of the run
+bench_results: list[dict[str, typing.Any]] = []
+
+@pytest.fixture
+def bench_report() -> typing.Callable[[dict[str, typing.Any]], None]:
+   return bench_results.append
+
+@pytest.fixture
+def fake_nix(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> pathlib.Path:
+   """Puts the fake nix on the PATH and returns its log"""
+   log = tmp_path / "nix.log"
+   monkeypatch.setenv("PATH", f"{tests / 'fake_nix'}:{os.environ['PATH']}")
+   monkeypatch.setenv("FAKE_NIX_STORE", str(tmp_path / "store"))
+   monkeypatch.setenv("FAKE_NIX_LOG", str(log))
+   monkeypatch.delenv("ZILCH_PATH", raising=False)
+   monkeypatch.delenv("ZILCH_DAEMON_SOCKET", raising=False)
+   monkeypatch.setattr(zilch.api, "DEFAULT_CACHE_PATH", tmp_path / "cache")
+   monkeypatch.setattr(zilch.api, "DEFAULT_DATA_PATH", tmp_path / "data")
+   zilch.api.get_system.cache_clear()
+   log.touch()
+   return log
+
+@pytest.fixture
+def project_dir(tmp_path: pathlib.Path, fake_nix: pathlib.Path) -> pathlib.Path:
+   """A directory with a new zilch.toml, whose resources are kept under `tmp_path`"""
+   (tmp_path / "zilch.toml").write_text(f'resource_path = "{tmp_path / "resources"}"\n')
+   return tmp_path
+
+def nix_call_count(log: pathlib.Path) -> int:
+   """How many calls the fake nix has logged so far"""
+   return len(log.read_text().splitlines())
+
+def nix_calls_since(log: pathlib.Path, start: int) -> list[list[str]]:
+   """The argv of each call the fake nix logged after the first `start`"""
+   return [json.loads(line)["argv"] for line in log.read_text().splitlines()[start:]]
+
+def pytest_terminal_summary(terminalreporter: typing.Any) -> None:
+   if bench_results:
+      terminalreporter.section("zilch benchmarks")
+      terminalreporter.write_line(f"{'command':<20} {'wall (s)':>9} {'python (s)':>11} {'nix (s)':>8} {'nix calls':>10}")
+      for result in bench_results:
+         terminalreporter.write_line(
+            f"{result['name']:<20} {result['wall']:>9.3f} {result['python']:>11.3f} {result['nix']:>8.3f} {result['nix_calls']:>10}"
+         )
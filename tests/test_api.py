@@ -0,0 +1,394 @@
+import dataclasses
+import io
+import json
+import os
+import pathlib
+import subprocess
+
+import pytest
+from conftest import nix_call_count, nix_calls_since
+
+import zilch.api
+from zilch.api import (
+   NixPackage,
+   NixSource,
+   ZilchError,
+   ZilchProject,
+   ZilchTomlError,
+   iter_json_object,
+)
+
+
+def test_iter_json_object() -> None:
+   data: dict[str, object] = {
+      f"legacyPackages.x86_64-linux.pkg{i}": {"pname": f"pkg{i}", "version": f"1.{i}", "description": "}{,:\"" * i}
+      for i in range(100)
+   }
+   data["number"] = 12345
+   for text in [json.dumps(data), json.dumps(data, indent=2)]:
+      for chunk_size in [1, 7, 1 << 16]:
+         assert dict(iter_json_object(io.StringIO(text), chunk_size)) == data
+   assert list(iter_json_object(io.StringIO(" {} "))) == []
+   for bad in ["", "[]", '{"a": 1', '{"a" 1}']:
+      with pytest.raises(ValueError):
+         list(iter_json_object(io.StringIO(bad)))
+
+def test_sync_skips_unchanged(project_dir: pathlib.Path, fake_nix: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+   project = ZilchProject.from_path(project_dir)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+   start = nix_call_count(fake_nix)
+   project.sync()
+   ZilchProject.from_path(project_dir).sync()
+   assert nix_calls_since(fake_nix, start) == []
+
+   # A package change rebuilds
+   project.add_package(NixPackage("pkg1", project.sources["nixpkgs"]))
+   project.sync()
+   assert [call[0] for call in nix_calls_since(fake_nix, start)] == ["build"]
+
+   # So does a change to the flake template
+   template = project_dir / "root" / "flake.nix.template"
+   template.parent.mkdir()
+   template.write_text((zilch.api.root / "flake.nix.template").read_text() + "# changed\n")
+   monkeypatch.setattr(zilch.api, "root", template.parent)
+   start = nix_call_count(fake_nix)
+   project.sync()
+   assert [call[:2] for call in nix_calls_since(fake_nix, start)] == [["flake", "lock"], ["build", project.flake_ref]]
+   assert project.is_synced()
+
+def test_env_vars_cache(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+   outer_env = dict(os.environ)
+   env_vars = project.get_env_vars(outer_env)
+   start = nix_call_count(fake_nix)
+   assert project.get_env_vars(outer_env) == env_vars
+   assert nix_calls_since(fake_nix, start) == []
+
+   # The result sets PATH, so a different outer PATH needs a new `nix shell`
+   project.get_env_vars({**outer_env, "PATH": f"{outer_env['PATH']}:/elsewhere"})
+   assert [call[0] for call in nix_calls_since(fake_nix, start)] == ["shell"]
+
+   # As does a new build
+   with project.transaction():
+      project.add_package(NixPackage("pkg1", project.sources["nixpkgs"]))
+   start = nix_call_count(fake_nix)
+   assert project.get_env_vars(outer_env) != env_vars
+   assert [call[0] for call in nix_calls_since(fake_nix, start)] == ["shell"]
+
+def test_system_cache(fake_nix: pathlib.Path) -> None:
+   source = NixSource("github:NixOS/nixpkgs", "nixpkgs", None)
+   # Packages only need the system for their attribute
+   package = NixPackage.from_name("hello", source)
+   assert package.name == "hello"
+   assert nix_calls_since(fake_nix, 0) == []
+   assert package.attribute == "legacyPackages.x86_64-linux.hello"
+   assert len(nix_calls_since(fake_nix, 0)) == 1
+
+   # Later invocations read it from system.json
+   zilch.api.get_system.cache_clear()
+   assert NixPackage.from_name("hello", source).attribute == "legacyPackages.x86_64-linux.hello"
+   assert len(nix_calls_since(fake_nix, 0)) == 1
+   assert (zilch.api.DEFAULT_CACHE_PATH / "system.json").exists()
+
+def test_transaction_locks_and_builds_once(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   sources = [NixSource(f"github:example/repo{i}", f"repo{i}", None) for i in range(3)]
+   start = nix_call_count(fake_nix)
+   with project.transaction():
+      for i in range(10):
+         project.add_package(NixPackage(f"pkg{i}", dataclasses.replace(sources[i % 3])))
+   calls = [call[:2] for call in nix_calls_since(fake_nix, start)]
+   assert calls.count(["flake", "lock"]) == 1
+   assert [call[0] for call in calls].count("build") == 1
+
+   reloaded = ZilchProject.from_path(project_dir)
+   assert list(reloaded.sources) == ["nixpkgs", "repo0", "repo1", "repo2"]
+   assert all(source.rev is not None for source in reloaded.sources.values())
+   assert len(reloaded.packages) == 10
+   assert reloaded.is_synced()
+
+def test_package_changes_skip_lock(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   project.sync()
+   flake = (project.flake_path / "flake.nix").read_text()
+   start = nix_call_count(fake_nix)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+      project.add_package(NixPackage("python3Packages.numpy", project.sources["nixpkgs"]))
+   calls = [call[:2] for call in nix_calls_since(fake_nix, start)]
+   assert calls == [["build", f"path:{project.flake_path}#zilch-env"]]
+   assert (project.flake_path / "flake.nix").read_text() == flake
+   assert project.installed() == [True, True]
+
+def test_follows(tmp_path: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   toml = "\n".join([
+      f'resource_path = "{tmp_path / "resources"}"',
+      "[[sources]]",
+      'url = "github:NixOS/nixpkgs"',
+      'alias = "nixpkgs"',
+      f'rev = "{"0" * 40}"',
+      "[[sources]]",
+      'url = "github:nix-community/NUR"',
+      'alias = "nur"',
+      f'rev = "{"1" * 40}"',
+      'follows = { nixpkgs = "nixpkgs" }',
+   ])
+   (tmp_path / "zilch.toml").write_text(toml)
+   project = ZilchProject.from_path(tmp_path)
+   assert project.sources["nur"].follows == {"nixpkgs": "nixpkgs"}
+   project.sync()
+   assert 'nur.inputs.nixpkgs.follows = "nixpkgs";' in (project.flake_path / "flake.nix").read_text()
+
+   # Changing what a source follows changes the inputs, so it needs a new lock
+   (tmp_path / "zilch.toml").write_text(toml.replace('{ nixpkgs = "nixpkgs" }', '{ flake-utils = "flake-utils" }'))
+   project = ZilchProject.from_path(tmp_path)
+   start = nix_call_count(fake_nix)
+   project.sync()
+   calls = [call[:2] for call in nix_calls_since(fake_nix, start)]
+   assert ["flake", "lock"] in calls
+   assert 'nur.inputs.flake-utils.follows = "flake-utils";' in (project.flake_path / "flake.nix").read_text()
+
+   (tmp_path / "zilch.toml").write_text(toml.replace('{ nixpkgs = "nixpkgs" }', '{ nixpkgs = "nixpkgs-unstable" }'))
+   with pytest.raises(ZilchTomlError):
+      ZilchProject.from_path(tmp_path)
+
+def test_search_and_registry_use_rev(tmp_path: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   rev = "0" * 40
+   (tmp_path / "zilch.toml").write_text("\n".join([
+      f'resource_path = "{tmp_path / "resources"}"',
+      "registry = true",
+      "[[sources]]",
+      'url = "github:NixOS/nixpkgs"',
+      'alias = "nixpkgs"',
+      f'rev = "{rev}"',
+   ]))
+   project = ZilchProject.from_path(tmp_path)
+   assert [package.name for package in project.search(project.sources["nixpkgs"], ["hello"])] == ["hello"]
+   searches = [call for call in nix_calls_since(fake_nix, 0) if call[0] == "search"]
+   assert searches == [["search", f"github:NixOS/nixpkgs?rev={rev}", "^", "--json"]]
+
+   project.sync()
+   registry = json.loads(project.registry_path.read_text())
+   assert [(flake["from"]["id"], flake["to"]["url"]) for flake in registry["flakes"]] == [
+      ("nixpkgs", f"github:NixOS/nixpkgs?rev={rev}"),
+   ]
+   # No temporary registry or `result` link is left behind
+   assert not [path.name for path in project.resource_path.iterdir() if path.name.startswith(".")]
+   assert f"flake-registry = {project.registry_path}" in project.get_env_vars()["NIX_CONFIG"]
+
+def test_search_many(project_dir: pathlib.Path, fake_nix: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+   monkeypatch.setenv("FAKE_NIX_LATENCY", json.dumps({"search": 0.5}))
+   monkeypatch.setattr(zilch.api, "MAX_NIX_JOBS", 3)
+   project = ZilchProject.from_path(project_dir, read_only=True)
+   sources = [
+      NixSource("github:example/repo1", "repo1", None),
+      NixSource("github:example/repo2", "repo2", None),
+      NixSource(f"git+file://{project_dir / 'missing'}", "missing", None),
+   ]
+   results = {}
+   for source, packages in project.search_many(sources, ["pkg1"], limit=5):
+      if source.alias == "missing":
+         # The failure of one source is raised from its results, and does not stop the others
+         with pytest.raises(subprocess.CalledProcessError):
+            list(packages)
+      else:
+         results[source.alias] = [package.name for package in packages]
+   # Each source's results come in the order Nix found them
+   assert results == {alias: ["pkg1", "pkg10", "pkg11", "pkg12", "pkg13"] for alias in ["repo1", "repo2"]}
+   # The searches ran at the same time
+   calls = [json.loads(line) for line in fake_nix.read_text().splitlines()]
+   searches = [call for call in calls if call["argv"][0] == "search"]
+   assert len(searches) == 3
+   assert max(call["start"] for call in searches) < min(call["start"] + call["duration"] for call in searches)
+
+def test_snapshot(tmp_path: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   toml = "\n".join([
+      f'resource_path = "{tmp_path / "resources"}"',
+      "[[sources]]",
+      'url = "github:NixOS/nixpkgs"',
+      'alias = "nixpkgs"',
+      f'rev = "{"0" * 40}"',
+      'follows = { flake-utils = "flake-utils" }',
+      "[[packages]]",
+      'name = "hello"',
+      'source = "nixpkgs"',
+   ])
+   (tmp_path / "zilch.toml").write_text(toml)
+   parsed = ZilchProject.from_path(tmp_path, read_only=True)
+   assert parsed._toml_doc is not None
+   snapshot = ZilchProject.from_path(tmp_path, read_only=True)
+   assert snapshot._toml_doc is None
+   assert (snapshot.sources, snapshot.packages, snapshot.resource_path) == (parsed.sources, parsed.packages, parsed.resource_path)
+   assert snapshot.toml_doc["packages"][0]["name"] == "hello"
+
+   # Any change to the TOML invalidates the snapshot, even one that keeps the size
+   (tmp_path / "zilch.toml").write_text(toml.replace("hello", "jello"))
+   changed = ZilchProject.from_path(tmp_path, read_only=True)
+   assert changed._toml_doc is not None
+   assert list(changed.packages) == [("nixpkgs", "jello")]
+
+   # Writing the TOML refreshes the snapshot
+   project = ZilchProject.from_path(tmp_path)
+   project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+   project.sync()
+   snapshot = ZilchProject.from_path(tmp_path, read_only=True)
+   assert snapshot._toml_doc is None
+   assert list(snapshot.packages) == [("nixpkgs", "jello"), ("nixpkgs", "hello")]
+
+def test_add_remove_packages(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   nixpkgs = project.sources["nixpkgs"]
+   for name in ["a", "b", "c", "d"]:
+      project.add_package(NixPackage(name, nixpkgs))
+   project.remove_package(NixPackage("b", nixpkgs), any_source=False)
+   project.add_package(NixPackage("e", nixpkgs))
+   project.remove_package(NixPackage("e", nixpkgs), any_source=False)
+   project.remove_package(NixPackage("c", nixpkgs), any_source=False)
+   project.add_package(NixPackage("b", nixpkgs))
+   project._validate()
+   assert [p["name"] for p in project.toml_doc["packages"]] == ["a", "d", "b"]
+   project._write_toml()
+   project.remove_package(NixPackage("a", nixpkgs), any_source=False)
+   project._write_toml()
+   assert list(ZilchProject.from_path(project_dir).packages) == [("nixpkgs", "d"), ("nixpkgs", "b")]
+
+def test_autoremove(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   assert project.autoremove() == ([], 0)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+      project.add_package(NixPackage("pkg1", project.sources["nixpkgs"]))
+   old_env = (project.resource_path / "result").resolve()
+   pkg1 = (old_env / "bin" / "pkg1").resolve().parent.parent
+   with project.transaction():
+      project.remove_package(NixPackage("pkg1", project.sources["nixpkgs"]), any_source=False)
+   current_env = (project.resource_path / "result").resolve()
+
+   paths, size = project.autoremove(dry_run=True)
+   assert paths == sorted([old_env, pkg1])
+   assert size > 0
+   assert old_env.exists() and pkg1.exists()
+
+   assert project.autoremove() == (paths, size)
+   assert not old_env.exists() and not pkg1.exists()
+   assert (current_env / "bin" / "hello").exists()
+   assert project.autoremove() == ([], 0)
+
+def test_generations(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+   toml = (project_dir / "zilch.toml").read_text()
+   env_vars = project.get_env_vars()
+   with project.transaction():
+      project.add_package(NixPackage("pkg1", project.sources["nixpkgs"]))
+   assert project.generations() == [1, 2]
+   assert project.current_generation() == 2
+
+   start = nix_call_count(fake_nix)
+   assert project.rollback() == 1
+   project = ZilchProject.from_path(project_dir)
+   assert project.current_generation() == 1
+   assert (project_dir / "zilch.toml").read_text() == toml
+   assert list(project.packages) == [("nixpkgs", "hello")]
+   assert project.is_synced()
+   assert project.get_env_vars() == env_vars
+   project.sync()
+   # No evaluation, build, or `nix shell`: the environment was cached with its generation
+   assert nix_calls_since(fake_nix, start) == []
+
+   # Generations after the current one are only removed on request
+   project.autoremove()
+   assert project.generations() == [1, 2]
+   paths, _ = project.autoremove(dry_run=True, newer=True)
+   assert paths and project.generations() == [1, 2]
+
+   project.switch_generation(2)
+   project = ZilchProject.from_path(project_dir)
+   assert list(project.packages) == [("nixpkgs", "hello"), ("nixpkgs", "pkg1")]
+   with pytest.raises(ZilchError):
+      project.switch_generation(3)
+   project.switch_generation(1)
+   project.autoremove(newer=True)
+   assert project.generations() == [1]
+
+def test_pin_version(tmp_path: pathlib.Path, fake_nix: pathlib.Path, project_dir: pathlib.Path) -> None:
+   from zilch.versions import VersionCache, compare_versions, evaluate
+   assert compare_versions("1.10", "1.9") == 1
+   assert compare_versions("2.0pre1", "2.0") == -1
+   assert compare_versions("2.0", "2.0.0") == -1
+
+   repo = tmp_path / "repo"
+   (repo / "pkgs").mkdir(parents=True)
+   def commit(path: str, text: str) -> str:
+      (repo / path).write_text(text)
+      git = ["git", "-C", str(repo), "-c", "user.name=test", "-c", "user.email=test@example.com"]
+      subprocess.run([*git, "add", path], check=True)
+      subprocess.run([*git, "commit", "--quiet", "-m", path], check=True)
+      return subprocess.run([*git, "rev-parse", "HEAD"], check=True, capture_output=True, text=True).stdout.strip()
+   subprocess.run(["git", "init", "--quiet", str(repo)], check=True)
+   revs = {}
+   for i, version in enumerate(["1.0", "1.1", "1.9", "1.10", "2.0", "2.0", "2.1"]):
+      revs[version] = commit("pkgs/hello.nix", f'version = "{version}";\n# {i}\n')
+      commit("README", f"{i}\n")
+   project = ZilchProject.from_path(project_dir)
+   source = NixSource(f"git+file://{repo}", "repo", revs["2.1"])
+
+   start = nix_call_count(fake_nix)
+   pinned = project.pin_version(NixPackage("hello", source), "1.10")
+   evals = [call for call in nix_calls_since(fake_nix, start) if "meta.position" in " ".join(call)]
+   assert pinned.source.rev == revs["1.10"]
+   assert pinned.source.url == source.url
+   assert len(evals) <= 5
+   # Of several commits with the version, the newest is used
+   assert project.pin_version(NixPackage("hello", source), "2.0").source.rev == revs["2.0"]
+   assert project.pin_version(NixPackage("hello", source), "2.1").source == source
+   with pytest.raises(ZilchError, match="closest are 1.1 and 1.9"):
+      project.pin_version(NixPackage("hello", source), "1.5")
+
+   # A failure other than a missing package is not taken for an old rev
+   with VersionCache(tmp_path / "versions.sqlite") as cache, pytest.raises(ZilchError, match="Cannot evaluate"):
+      evaluate(NixSource("github:example/repo", "repo", revs["1.0"]), "legacyPackages.x86_64-linux.hello", cache)
+   with VersionCache(tmp_path / "versions.sqlite") as cache:
+      assert evaluate(dataclasses.replace(source, rev=revs["1.0"]), "legacyPackages.x86_64-linux.nope", cache) == (None, None)
+
+   # Evaluations are cached on disk
+   start = nix_call_count(fake_nix)
+   assert project.pin_version(NixPackage("hello", source), "1.10") == pinned
+   assert not [call for call in nix_calls_since(fake_nix, start) if "meta.position" in " ".join(call)]
+
+   with project.transaction():
+      project.add_package(pinned)
+   assert project.sources[pinned.source.alias].rev == revs["1.10"]
+   assert project.installed() == [True]
+
+   # Versions of a package would collide in the environment, so only one can be added
+   newer = project.pin_version(NixPackage("hello", source), "2.0")
+   with pytest.raises(ZilchError, match="already added"):
+      project.add_package(newer)
+   with project.transaction():
+      project.add_package(newer, replace=True)
+   assert list(project.packages) == [(newer.source.alias, "hello")]
+   # The old pin is no longer used, so it is removed rather than locked on every sync
+   assert list(project.sources) == ["nixpkgs", newer.source.alias]
+   assert list(ZilchProject.from_path(project_dir).sources) == ["nixpkgs", newer.source.alias]
+   assert project.installed() == [True]
+   # As is the pin of a removed package
+   with project.transaction():
+      project.remove_package(newer, any_source=False)
+   assert list(ZilchProject.from_path(project_dir).sources) == ["nixpkgs"]
+
+def test_check_package(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   project = ZilchProject.from_path(project_dir)
+   project.sync()
+   nixpkgs = project.sources["nixpkgs"]
+   start = nix_call_count(fake_nix)
+   project.check_package(NixPackage("hello", nixpkgs))
+   project.check_package(NixPackage("pkg12.foo", nixpkgs))
+   with pytest.raises(ZilchError, match="did you mean hello"):
+      project.check_package(NixPackage("helo", nixpkgs))
+   # The names are fetched once per rev
+   assert len(nix_calls_since(fake_nix, start)) == 1
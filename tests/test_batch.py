@@ -0,0 +1,40 @@
+import pathlib
+
+from conftest import nix_call_count, nix_calls_since
+
+from zilch.api import ZilchProject, ZilchTomlError
+from zilch.batch import sync_all
+
+
+def test_sync_all(tmp_path: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   dirs = [tmp_path / f"project{i}" for i in range(6)]
+   for i, project_dir in enumerate(dirs):
+      project_dir.mkdir()
+      # Projects 0 and 1 are new (so they get the default source, without a rev); 2 and 3 have packages
+      source = f'\n[[sources]]\nurl = "github:NixOS/nixpkgs"\nalias = "nixpkgs"\nrev = "{"0" * 40}"\n' if i >= 2 else ""
+      packages = "".join(f'\n[[packages]]\nname = "pkg{j}"\nsource = "nixpkgs"\n' for j in range(i if i >= 2 else 0))
+      (project_dir / "zilch.toml").write_text(f'resource_path = "{project_dir / "resources"}"\n{source}{packages}')
+   # Broken projects (here, a source without an alias, and invalid TOML) do not stop the others
+   (dirs[4] / "zilch.toml").write_text("[[sources]]\nurl = 1\n")
+   (dirs[5] / "zilch.toml").write_text("[[sources]\n")
+   messages: list[tuple[pathlib.Path, str]] = []
+   errors = sync_all(dirs, lambda toml_path, message: messages.append((toml_path, message)))
+
+   assert [toml_path.parent for toml_path, error in errors.items() if error is not None] == dirs[4:]
+   assert all(isinstance(errors[project_dir / "zilch.toml"], ZilchTomlError) for project_dir in dirs[4:])
+   calls = nix_calls_since(fake_nix, 0)
+   # One lookup of nixpkgs for all projects, one lock per set of sources (0 and 1, 2 and 3), and one shared build
+   assert sum(call[:2] == ["flake", "metadata"] for call in calls) == 1
+   assert sum(call[:2] == ["flake", "lock"] for call in calls) == 2
+   assert sum(call[0] == "build" and "--no-link" in call for call in calls) == 1
+   for project_dir in dirs[:4]:
+      project = ZilchProject.from_path(project_dir)
+      assert project.is_synced()
+      assert all(project.installed())
+      assert project.sources["nixpkgs"].rev is not None
+      assert ((project_dir / "zilch.toml").absolute(), "done") in messages
+
+   # Up-to-date projects are not rebuilt
+   start = nix_call_count(fake_nix)
+   assert not any(sync_all(dirs[:4]).values())
+   assert nix_calls_since(fake_nix, start) == []
@@ -0,0 +1,101 @@
+"""Benchmarks of CLI commands against a fake `nix` (see tests/fake_nix/nix).
+
+Each command is reported with its wall time, the CPU time spent in Python (in this process),
+the time spent in (fake) Nix, and the number of Nix invocations.
+A run fails if a command makes more Nix invocations than its baseline in bench_baselines.json,
+or takes much more Python time (see $ZILCH_BENCH_TOLERANCE).
+Run with ZILCH_BENCH_UPDATE=1 to record new baselines.
+"""
+import json
+import os
+import pathlib
+import time
+import typing
+
+import pytest
+from click.testing import CliRunner
+from conftest import nix_call_count
+
+import zilch.cli
+
+tests = pathlib.Path(__file__).parent
+baselines_path = tests / "bench_baselines.json"
+TOLERANCE = float(os.environ.get("ZILCH_BENCH_TOLERANCE", "3"))
+UPDATE = bool(int(os.environ.get("ZILCH_BENCH_UPDATE", "0")))
+REV = "0" * 40
+
+def write_manifest(path: pathlib.Path, n_packages: int) -> None:
+   lines = [
+      f'resource_path = "{path / "resources"}"',
+      "",
+      "[[sources]]",
+      'url = "github:NixOS/nixpkgs"',
+      'alias = "nixpkgs"',
+      f'rev = "{REV}"',
+   ]
+   for i in range(n_packages):
+      lines.extend(["", "[[packages]]", f'name = "pkg{i}"', 'source = "nixpkgs"'])
+   (path / "zilch.toml").write_text("\n".join(lines) + "\n")
+
+def run(project: pathlib.Path, args: list[str], log: pathlib.Path) -> dict[str, typing.Any]:
+   log_start = nix_call_count(log)
+   wall_start = time.perf_counter()
+   python_start = time.process_time()
+   result = CliRunner().invoke(
+      zilch.cli.cli,
+      # Text output unless the command asks for --json (CliRunner's stdout is not a terminal)
+      ["--path", str(project), "--text", *args],
+      catch_exceptions=False,
+   )
+   python = time.process_time() - python_start
+   wall = time.perf_counter() - wall_start
+   assert result.exit_code == 0, result.output
+   calls = [json.loads(line) for line in log.read_text().splitlines()[log_start:]]
+   return {
+      "wall": wall,
+      "python": python,
+      "nix": sum(call["duration"] for call in calls),
+      "nix_calls": len(calls),
+   }
+
+COMMANDS = [
+   ("install", ["install", "hello"]),
+   ("uninstall", ["uninstall", "hello"]),
+   ("search", ["search", "pkg1"]),
+   ("search --json", ["--json", "search", "pkg"]),
+   ("info", ["info", "pkg0"]),
+   ("list", ["list"]),
+   ("list --json", ["--json", "list"]),
+   ("shell", ["shell", "true"]),
+]
+
+@pytest.mark.parametrize("n_packages", [10, 100, 1000])
+def test_bench(
+      n_packages: int,
+      tmp_path: pathlib.Path,
+      fake_nix: pathlib.Path,
+      bench_report: typing.Callable[[dict[str, typing.Any]], None],
+) -> None:
+   write_manifest(tmp_path, n_packages)
+   # Warm up: build the environment once
+   run(tmp_path, ["shell", "true"], fake_nix)
+
+   baselines = json.loads(baselines_path.read_text()) if baselines_path.exists() else {}
+   failures = []
+   for command, args in COMMANDS:
+      name = f"{command}[{n_packages}]"
+      result = run(tmp_path, args, fake_nix)
+      bench_report({"name": name, **result})
+      if UPDATE:
+         baselines[name] = {"nix_calls": result["nix_calls"], "python": round(result["python"], 3)}
+      elif name in baselines:
+         baseline = baselines[name]
+         if result["nix_calls"] > baseline["nix_calls"]:
+            failures.append(f"{name} made {result['nix_calls']} Nix calls (baseline {baseline['nix_calls']})")
+         if result["python"] > TOLERANCE * baseline["python"] + 0.1:
+            failures.append(f"{name} took {result['python']:.3f}s of Python time (baseline {baseline['python']:.3f}s)")
+      else:
+         failures.append(f"{name} has no baseline; run with ZILCH_BENCH_UPDATE=1")
+   if UPDATE:
+      baselines_path.write_text(json.dumps(dict(sorted(baselines.items())), indent=2) + "\n")
+   assert not failures, "\n".join(failures)
@@ -1,9 +1,11 @@
+import json
 import subprocess
 import os
 import pathlib
 import pytest
 from click.testing import CliRunner
 import platformdirs
+from conftest import nix_call_count, nix_calls_since
 import zilch.cli
 
 def test_zilch_project_uses_flag() -> None:
@@ -119,3 +121,47 @@ def test_install_remove() -> None:
          catch_exceptions=False,
       )
       assert result.exit_code != 0
+
+def test_json_output(project_dir: pathlib.Path) -> None:
+   runner = CliRunner()
+   path = ["--path", str(project_dir)]
+   runner.invoke(zilch.cli.cli, [*path, "install", "hello", "pkg1"], catch_exceptions=False)
+   # stdout is not a terminal, so JSON is the default
+   result = runner.invoke(zilch.cli.cli, [*path, "list"], catch_exceptions=False)
+   packages = [json.loads(line) for line in result.stdout.splitlines()]
+   assert [(p["name"], p["source"], p["installed"]) for p in packages] == [("hello", "nixpkgs", True), ("pkg1", "nixpkgs", True)]
+   assert packages[0]["attribute"] == "legacyPackages.x86_64-linux.hello"
+   result = runner.invoke(zilch.cli.cli, [*path, "--json", "search", "hello"], catch_exceptions=False)
+   assert [json.loads(line)["version"] for line in result.stdout.splitlines()] == ["2.12.1"]
+   result = runner.invoke(zilch.cli.cli, [*path, "--text", "list"], catch_exceptions=False)
+   assert "hello" in result.stdout and not result.stdout.startswith("{")
+   # Warnings go to stderr, and do not break the JSON
+   toml = (project_dir / "zilch.toml").read_text()
+   (project_dir / "zilch.toml").write_text(toml + '\n[[packages]]\nname = "hello"\nsource = "nixpkgs"\n')
+   result = runner.invoke(zilch.cli.cli, [*path, "list"], catch_exceptions=False)
+   assert [json.loads(line)["name"] for line in result.stdout.splitlines()] == ["hello", "pkg1"]
+   assert "Removing duplicate" in result.stderr
+
+def test_install_unknown_package(project_dir: pathlib.Path) -> None:
+   runner = CliRunner()
+   path = ["--path", str(project_dir)]
+   runner.invoke(zilch.cli.cli, [*path, "sync"], catch_exceptions=False)
+   result = runner.invoke(zilch.cli.cli, [*path, "--text", "install", "helo"], catch_exceptions=False)
+   # A one-line error, not a traceback
+   assert result.exit_code == 1
+   assert "Error: Cannot add helo" in result.stdout and "did you mean hello" in result.stdout
+   assert "Traceback" not in result.output
+   assert "helo" not in (project_dir / "zilch.toml").read_text()
+
+def test_autoremove_dry_run(project_dir: pathlib.Path, fake_nix: pathlib.Path) -> None:
+   runner = CliRunner()
+   path = ["--path", str(project_dir)]
+   runner.invoke(zilch.cli.cli, [*path, "install", "hello"], catch_exceptions=False)
+   toml = (project_dir / "zilch.toml").read_text()
+   (project_dir / "zilch.toml").write_text(toml + '\n[[packages]]\nname = "pkg1"\nsource = "nixpkgs"\n')
+   start = nix_call_count(fake_nix)
+   result = runner.invoke(zilch.cli.cli, [*path, "--text", "autoremove", "--dry-run"], catch_exceptions=False)
+   assert "Would remove up to 0 store paths" in result.stdout
+   # Neither synced nor changed
+   assert not any(call[0] == "build" for call in nix_calls_since(fake_nix, start))
+   assert zilch.api.ZilchProject.from_path(project_dir, read_only=True).generations() == [1]
@@ -0,0 +1,73 @@
+import json
+import os
+import pathlib
+import threading
+
+import pytest
+from click.testing import CliRunner
+
+import zilch.cli
+from zilch import daemon
+
+
+def test_daemon(project_dir: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+   runner = CliRunner()
+   def zilch_json(*args: str) -> list[dict[str, object]]:
+      result = runner.invoke(zilch.cli.cli, ["--path", str(project_dir), "--json", *args], catch_exceptions=False)
+      assert result.exit_code == 0, result.output
+      return [json.loads(line) for line in result.stdout.splitlines()]
+   runner.invoke(zilch.cli.cli, ["--path", str(project_dir), "install", "hello"], catch_exceptions=False)
+   # No daemon yet: queries run in-process
+   in_process = zilch_json("list")
+   toml_path = project_dir / "zilch.toml"
+   env_vars = daemon.QUERIES["env"](zilch.api.ZilchProject.from_path(toml_path, read_only=True), dict(os.environ))
+
+   state = daemon.Daemon()
+   with state.server(daemon.socket_path()) as server:
+      thread = threading.Thread(target=server.serve_forever)
+      thread.start()
+      try:
+         assert zilch_json("list") == in_process
+         assert zilch_json("info", "hello")[0]["name"] == "hello"
+         assert [p["name"] for p in zilch_json("search", "hello")] == ["hello"]
+         # Streamed: a line per source and per result
+         assert list(daemon.request("search", toml_path, terms=["hello"], limit=None, source=None)) == [
+            ["nixpkgs", None],
+            ["nixpkgs", zilch_json("search", "hello")[0]],
+         ]
+         assert daemon.request("env", toml_path, environ=dict(os.environ)) == env_vars
+         assert list(state._projects) == [toml_path]
+
+         # Changes to the project (here, by this process) are picked up
+         runner.invoke(zilch.cli.cli, ["--path", str(project_dir), "install", "pkg1"], catch_exceptions=False)
+         assert [p["name"] for p in zilch_json("list")] == ["hello", "pkg1"]
+         result = runner.invoke(zilch.cli.cli, ["--path", str(project_dir), "--source", "nope", "list"])
+         assert result.exit_code != 0
+
+         # A project without a zilch.toml (yet) is queried like in-process, and `shell` syncs it
+         fresh = project_dir / "fresh"
+         fresh.mkdir()
+         result = runner.invoke(zilch.cli.cli, ["--path", str(fresh), "--json", "list"], catch_exceptions=False)
+         assert (result.exit_code, result.stdout) == (0, "")
+         assert daemon.request("env", fresh / "zilch.toml", environ=dict(os.environ)) is None
+         result = runner.invoke(zilch.cli.cli, ["--path", str(fresh), "shell", "true"], catch_exceptions=False)
+         assert result.exit_code == 0, result.output
+         assert (fresh / "zilch.toml").exists()
+
+         # Only the user can connect
+         assert daemon.socket_path().stat().st_mode & 0o777 == 0o600
+         with monkeypatch.context() as patch, pytest.raises(zilch.api.ZilchError, match="closed the connection"):
+            patch.setattr(os, "getuid", lambda: os.geteuid() + 1)
+            daemon.request("list", toml_path, source=None)
+
+         # Failures are reported, rather than taken for a missing daemon and re-run in-process
+         def broken(project: zilch.api.ZilchProject) -> None:
+            raise KeyError("oops")
+         monkeypatch.setitem(daemon.QUERIES, "broken", broken)
+         with pytest.raises(zilch.api.ZilchError, match="KeyError"):
+            daemon.request("broken", toml_path)
+      finally:
+         server.shutdown()
+         thread.join()
+   daemon.socket_path().unlink()
+   assert [p["name"] for p in zilch_json("list")] == ["hello", "pkg1"]
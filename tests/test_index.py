@@ -0,0 +1,54 @@
+import concurrent.futures
+import pathlib
+
+from zilch.api import NixPackage, NixSource
+from zilch.index import NameIndex, SearchIndex
+
+source = NixSource("github:NixOS/nixpkgs", "nixpkgs", "0" * 40)
+packages = [
+   NixPackage("hello", source, "2.12", "A program that produces a familiar, friendly greeting", _system="x86_64-linux"),
+   NixPackage("firefox", source, "120.0", "A web browser built from Firefox source tree", _system="x86_64-linux"),
+   NixPackage("python311Packages.requests", source, "2.31", "HTTP library for Python", _system="x86_64-linux"),
+   NixPackage("hello-wayland", source, "0.1", "Hello world Wayland client", _system="x86_64-linux"),
+]
+
+def test_search_index(tmp_path: pathlib.Path) -> None:
+   index = SearchIndex.for_source(tmp_path, source)
+   assert not index.exists()
+   index.build(packages)
+   assert index.exists()
+   assert [p.name for p in index.search(source, ["hello"])] == ["hello", "hello-wayland"]
+   assert [p.name for p in index.search(source, ["fox"])] == ["firefox"]
+   assert [p.name for p in index.search(source, ["py", "http"])] == ["python311Packages.requests"]
+   assert [p.name for p in index.search(source, [r"\.hello$"])] == ["hello"]
+   assert list(index.search(source, ["nonexistent"])) == []
+   hello = next(iter(index.search(source, ["greeting"])))
+   assert hello == packages[0]
+   assert hello.attribute == "legacyPackages.x86_64-linux.hello"
+
+def test_search_index_replaces_old_revs(tmp_path: pathlib.Path) -> None:
+   SearchIndex.for_source(tmp_path, source).build(packages)
+   new_source = NixSource(source.url, source.alias, "1" * 40)
+   new_index = SearchIndex.for_source(tmp_path, new_source)
+   new_index.build(packages[:1])
+   assert list((tmp_path / "search").iterdir()) == [new_index.db_path]
+
+def test_concurrent_builds(tmp_path: pathlib.Path) -> None:
+   # E.g. cold searches of the same source in several threads of the daemon
+   index = SearchIndex.for_source(tmp_path, source)
+   with concurrent.futures.ThreadPoolExecutor(8) as executor:
+      list(executor.map(lambda _: index.build(packages * 200), range(8)))
+   assert list((tmp_path / "search").iterdir()) == [index.db_path]
+   assert [p.name for p in index.search(source, ["fox"])] == ["firefox"] * 200
+
+def test_name_index(tmp_path: pathlib.Path) -> None:
+   index = NameIndex.for_source(tmp_path, source)
+   index.build(["hello", "hello-wayland", "firefox", "firefox-esr", "python3", "python3Packages", "gcc", "gcc9", "jq"])
+   assert "hello" in index
+   assert "helo" not in index
+   assert index.suggest("helo") == ["hello"]
+   assert index.suggest("hlelo") == ["hello"]
+   assert index.suggest("firefx") == ["firefox"]
+   assert index.suggest("python3Pakages") == ["python3Packages"]
+   assert index.suggest("jw") == ["jq"]
+   assert index.suggest("unrelated") == []
@@ -0,0 +1,68 @@
+import fcntl
+import json
+import os
+import pathlib
+import subprocess
+import sys
+
+from zilch.api import NixPackage, ProjectLock, ZilchProject
+
+
+def is_locked(path: pathlib.Path, shared: bool) -> bool:
+   """Whether another process would have to wait for the lock"""
+   with open(path) as file:
+      try:
+         fcntl.flock(file, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+      except BlockingIOError:
+         return True
+      return False
+
+def test_project_lock(tmp_path: pathlib.Path) -> None:
+   with ProjectLock(tmp_path / "lock").acquire(shared=True) as lock:
+      assert not is_locked(lock.path, shared=True)
+      assert is_locked(lock.path, shared=False)
+      lock.acquire(shared=False)
+      assert is_locked(lock.path, shared=True)
+      # Stays exclusive
+      lock.acquire(shared=True)
+      assert is_locked(lock.path, shared=True)
+   assert not is_locked(lock.path, shared=False)
+
+def test_concurrent_installs(project_dir: pathlib.Path) -> None:
+   env = {
+      **os.environ,
+      "XDG_DATA_HOME": str(project_dir / "data"),
+      "XDG_CACHE_HOME": str(project_dir / "cache"),
+      # Widen the window for a lost update
+      "FAKE_NIX_LATENCY": json.dumps({"build": 0.2}),
+   }
+   packages = [f"pkg{i}" for i in range(4)]
+   procs = [
+      subprocess.Popen(
+         [sys.executable, "-c", "from zilch.cli import cli; cli()", "--path", str(project_dir), "install", package],
+         cwd=pathlib.Path(__file__).parent.parent,
+         env=env,
+         stdout=subprocess.DEVNULL,
+      )
+      for package in packages
+   ]
+   assert [proc.wait() for proc in procs] == [0] * len(packages)
+   project = ZilchProject.from_path(project_dir, read_only=True)
+   assert sorted(name for _, name in project.packages) == packages
+   assert project.is_synced()
+   assert not list(project_dir.glob(".*.tmp"))
+
+def test_write_through_symlink(tmp_path: pathlib.Path, project_dir: pathlib.Path) -> None:
+   # E.g. a zilch.toml kept in a dotfiles repository
+   dotfiles = tmp_path / "dotfiles"
+   dotfiles.mkdir()
+   (project_dir / "zilch.toml").rename(dotfiles / "zilch.toml")
+   (dotfiles / "zilch.toml").chmod(0o640)
+   (project_dir / "zilch.toml").symlink_to(dotfiles / "zilch.toml")
+   project = ZilchProject.from_path(project_dir)
+   with project.transaction():
+      project.add_package(NixPackage("hello", project.sources["nixpkgs"]))
+   assert (project_dir / "zilch.toml").is_symlink()
+   assert 'name = "hello"' in (dotfiles / "zilch.toml").read_text()
+   assert (dotfiles / "zilch.toml").stat().st_mode & 0o777 == 0o640
+   assert not list(dotfiles.glob(".*.tmp"))
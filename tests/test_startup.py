@@ -0,0 +1,70 @@
+import os
+import pathlib
+import subprocess
+import sys
+
+import pytest
+from conftest import nix_calls_since
+
+root = pathlib.Path(__file__).parent.parent
+
+# Import time zilch adds on top of rich_click (which it cannot start without).
+# Measured at ~20ms under -X importtime (it was ~90ms when zilch.api and rich.table were imported eagerly);
+# the budget leaves room for slow CI machines.
+# Override with $ZILCH_STARTUP_BUDGET_MS.
+STARTUP_BUDGET_MS = float(os.environ.get("ZILCH_STARTUP_BUDGET_MS", "40"))
+
+def import_times(code: str) -> dict[str, int]:
+   """Run code under `python -X importtime` and return the cumulative import time (us) of each module"""
+   proc = subprocess.run(
+      [sys.executable, "-X", "importtime", "-c", code],
+      cwd=root,
+      capture_output=True,
+      text=True,
+      check=False,
+   )
+   times = {}
+   for line in proc.stderr.splitlines():
+      if line.startswith("import time:") and "|" in line:
+         _, cumulative, module = line.split("|")
+         if cumulative.strip().isdigit():
+            times[module.strip()] = int(cumulative)
+   return times
+
+def test_help_imports() -> None:
+   modules = import_times("import sys; sys.argv = ['zilch', '--help']; from zilch.cli import cli; cli()")
+   assert "zilch.cli" in modules
+   for module in ["zilch.api", "zilch.index", "tomlkit", "sqlite3", "concurrent.futures"]:
+      assert module not in modules, f"`zilch --help` should not import {module}"
+
+def test_shell_path_imports() -> None:
+   modules = import_times("import zilch.cli, zilch.api")
+   assert "zilch.api" in modules
+   for module in ["zilch.index", "tomlkit", "sqlite3", "concurrent.futures", "rich.table"]:
+      assert module not in modules, f"Importing zilch.api should not import {module}"
+
+def test_read_only_command_imports(project_dir: pathlib.Path, fake_nix: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+   monkeypatch.setenv("XDG_DATA_HOME", str(project_dir / "data"))
+   monkeypatch.setenv("XDG_CACHE_HOME", str(project_dir / "cache"))
+   toml = (project_dir / "zilch.toml").read_text()
+   code = f"import sys; sys.argv = ['zilch', '--path', {str(project_dir)!r}, 'list']; from zilch.cli import cli; cli()"
+   # The first run parses the TOML (and snapshots it), but locks and writes nothing
+   assert "tomlkit" in import_times(code)
+   assert not [argv for argv in nix_calls_since(fake_nix, 0) if argv[:2] == ["flake", "lock"]]
+   assert (project_dir / "zilch.toml").read_text() == toml
+   # Later runs load the snapshot instead
+   modules = import_times(code)
+   assert "zilch.cli" in modules
+   for module in ["tomlkit", "zilch.index", "sqlite3", "concurrent.futures"]:
+      assert module not in modules, f"`zilch list` of an unchanged project should not import {module}"
+
+def test_startup_time() -> None:
+   # Best of a few runs, to filter out noise
+   overhead_us = min(
+      times["zilch.cli"] - times["rich_click"]
+      for times in (import_times("import zilch.cli") for _ in range(3))
+   )
+   assert overhead_us / 1000 < STARTUP_BUDGET_MS, (
+      f"zilch.cli takes {overhead_us / 1000:.1f}ms to import on top of rich_click;"
+      f" the budget is {STARTUP_BUDGET_MS}ms"
+   )
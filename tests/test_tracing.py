@@ -0,0 +1,31 @@
+import json
+import pathlib
+import subprocess
+import sys
+
+import pytest
+
+from zilch import tracing
+
+
+def test_report(tmp_path: pathlib.Path, monkeypatch: pytest.MonkeyPatch) -> None:
+   monkeypatch.setattr(tracing, "_events", None)  # restored afterwards
+   tracing.enable()
+   with tracing.phase("outer"):
+      tracing.run([sys.executable, "-c", "print('hi')"], capture_output=True, check=True)
+      with pytest.raises(subprocess.CalledProcessError):
+         tracing.run([sys.executable, "-c", "exit(3)"], check=True)
+   report = tmp_path / "profile.json"
+   tracing.write_report(report)
+
+   summary = json.loads(report.read_text())
+   assert summary["nix_calls"] == 2
+   assert summary["phases"]["outer"]["count"] == 1
+   runs = [event for event in summary["events"] if event["category"] == "nix"]
+   assert [event["args"]["returncode"] for event in runs] == [0, 3]
+   assert runs[0]["args"]["output_size"] == 3
+   assert runs[0]["args"]["cwd"]
+   assert summary["phases"]["outer"]["seconds"] >= sum(event["duration"] for event in runs)
+
+   trace = json.loads(report.with_suffix(".trace.json").read_text())
+   assert {event["name"] for event in trace["traceEvents"]} == {"outer", tracing._name(runs[0]["args"]["argv"])}
@@ -1,19 +1,31 @@
 from __future__ import annotations
-import tomlkit
+import bisect
+import contextlib
 import functools
+import hashlib
 import os
-import urllib.parse
 import sys
 import platformdirs
 import dataclasses
 import json
 import pathlib
 import subprocess
+import threading
 import typing
+from . import tracing
+# tomlkit, sqlite3, concurrent.futures, etc. are imported where they are used,
+# to keep them off the startup path of commands that do not need them (see tests/test_startup.py).
+if typing.TYPE_CHECKING:
+    from typing import Self
+
+    import tomlkit
 root = pathlib.Path(__file__).parent.parent
 
 
-TomlAoT = tomlkit.items.AoT
+def toml_aot(container: typing.Any, key: str) -> tomlkit.items.AoT:
+    """Get an array of tables from a TOML document"""
+    import tomlkit
+    return expect_type(tomlkit.items.AoT, container[key])
 
 
 _T = typing.TypeVar("_T")
@@ -23,7 +35,7 @@ def expect_type(typ: type[_T], data: typing.Any) -> _T:
     return data
 
 
-def parse_attrpath(path) -> tuple[str, str, str]:
+def parse_attrpath(path: str) -> tuple[str, str, str]:
     """Parse attribute path from 'nix search'
 
     Args:
@@ -35,17 +47,137 @@ def parse_attrpath(path) -> tuple[str, str, str]:
     parts = path.split('.')
     return parts[0], parts[1], '.'.join(parts[2:])
 
+DEFAULT_CACHE_PATH = pathlib.Path(platformdirs.user_cache_dir()) / "zilch"
+DEFAULT_DATA_PATH = pathlib.Path(platformdirs.user_data_dir()) / "zilch"
+
+
+# Number of environments whose variables are cached (see `NixFlake.env_vars`)
+ENV_VARS_CACHE_SIZE = 8
+
+# Bump when the snapshot format (see `ZilchProject._write_snapshot`) changes
+SNAPSHOT_FORMAT = 1
+
+# Maximum number of Nix processes Zilch runs concurrently
+MAX_NIX_JOBS = min(4, os.cpu_count() or 1)
+
+# Results of each source that `ZilchProject.search_many` finds ahead of the caller
+SEARCH_QUEUE_SIZE = 64
+
+
+def write_atomic(path: pathlib.Path, text: str) -> None:
+    """Write a file through a temporary file next to it that is renamed over it,
+    so that concurrent readers (or a crash) never see it half-written
+
+    A symlink is followed, so that its target (e.g. a zilch.toml kept in a dotfiles repository) is what gets replaced,
+    and the file keeps its mode."""
+    path = path.resolve()
+    tmp_path = path.with_name(f".{path.name}.{os.getpid()}-{threading.get_ident()}.tmp")
+    try:
+        tmp_path.write_text(text)
+        try:
+            os.chmod(tmp_path, path.stat().st_mode & 0o7777)
+        except FileNotFoundError:
+            pass
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def iter_json_object(stream: typing.IO[str], chunk_size: int = 1 << 16) -> typing.Iterator[tuple[str, typing.Any]]:
+    """Incrementally decode the members of a JSON object from a stream.
+
+    Only one member (and one chunk) is held in memory at a time,
+    so this can consume e.g. `nix search --json` output of any size.
+
+    Raises:
+        ValueError: the stream is not a JSON object or ends early
+    """
+    decoder = json.JSONDecoder()
+    buf = ""
+    # Read offset into buf; what is before it is only dropped when the next chunk is read,
+    # so that each member does not copy the rest of the buffer
+    pos = 0
+    started = False
+    while True:
+        i = _skip_whitespace(buf, pos)
+        if i < len(buf):
+            if not started:
+                if buf[i] != "{":
+                    raise ValueError(f"Expected a JSON object, not {buf[i:i + 20]!r}")
+                started = True
+                pos = i + 1
+                continue
+            if buf[i] == "}":
+                return
+            if buf[i] == ",":
+                pos = i + 1
+                continue
+            try:
+                key, j = decoder.raw_decode(buf, i)
+                j = _skip_whitespace(buf, j)
+                if buf[j:j + 1] == ":":
+                    value, j = decoder.raw_decode(buf, _skip_whitespace(buf, j + 1))
+                    j = _skip_whitespace(buf, j)
+                    # A number at the end of the buffer might continue in the next chunk
+                    if j < len(buf):
+                        yield key, value
+                        pos = j
+                        continue
+            except json.JSONDecodeError:
+                pass
+        # buf does not contain a whole member after pos; read more
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            raise ValueError("JSON object ended early or is malformed")
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def nix_string(value: str) -> str:
+    """Quote a Python string as a Nix string literal"""
+    escaped = value.replace("\\", "\\\\").replace('"', '\\"').replace("${", "\\${")
+    return f'"{escaped}"'
+
+
+def _skip_whitespace(buf: str, i: int) -> int:
+    while i < len(buf) and buf[i] in " \t\n\r":
+        i += 1
+    return i
+
+
 @functools.cache
 def get_system() -> str:
-    """Get the Nix current system/platform"""
-    system = subprocess.run(
-        ["nix", "eval", "--impure", "--raw", "--expr",
-         "builtins.currentSystem"],
-        check=True,
-        capture_output=True,
-        text=True
-    ).stdout.strip()
-    return system
+    """Get the Nix current system/platform
+
+    Asking Nix starts its evaluator, so the answer is persisted across invocations.
+    The cache is keyed by the host and by the `nix` binary on the PATH;
+    the binary's resolved (store) path and mtime change whenever Nix is upgraded."""
+    import platform
+    import shutil
+    nix = shutil.which("nix")
+    nix_stat = os.stat(nix) if nix else None
+    key = ":".join([
+        platform.node(),
+        platform.machine(),
+        os.path.realpath(nix) if nix else "",
+        str(nix_stat.st_mtime_ns) if nix_stat else "",
+    ])
+    cache_path = DEFAULT_CACHE_PATH / "system.json"
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    if key not in cache:
+        cache[key] = tracing.run(
+            ["nix", "eval", "--impure", "--raw", "--expr",
+             "builtins.currentSystem"],
+            check=True,
+            capture_output=True,
+            text=True
+        ).stdout.strip()
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        write_atomic(cache_path, json.dumps(cache))
+    return expect_type(str, cache[key])
 
 class ZilchError(Exception):
     pass
@@ -58,6 +190,51 @@ class ZilchTomlError(ZilchError):
 DEFAULT_USER_GLOBAL = pathlib.Path(platformdirs.user_config_dir()) / "zilch/zilch.toml"
 
 
+class ProjectLock:
+    """Advisory reader/writer lock (flock) on a project, so that concurrent Zilch processes can share it.
+
+    Read-only users of the project take it shared; anything that changes or syncs the project takes it exclusively,
+    and must (re-)read the project after getting it.
+    Acquiring it again converts between the two, which is not atomic: another process may get the lock in between."""
+
+    def __init__(self, path: pathlib.Path) -> None:
+        self.path = path
+        # File descriptor of the lock file, while the lock is held
+        self._fd: int | None = None
+        self._shared = False
+
+    @staticmethod
+    def for_project(toml_path: pathlib.Path) -> ProjectLock:
+        """The lock of the project whose zilch.toml is at `toml_path`.
+
+        It does not live in the resource path, which is only known after reading the zilch.toml."""
+        return ProjectLock(ZilchProject.state_path(toml_path, ".lock"))
+
+    def acquire(self, shared: bool) -> ProjectLock:
+        """Blocks until the lock is held (shared or exclusive); an exclusive lock is kept even if `shared`"""
+        import fcntl
+        if self._fd is not None and (self._shared == shared or not self._shared):
+            return self
+        if self._fd is None:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            self._fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND)
+        with tracing.phase("wait for lock", shared=shared):
+            fcntl.flock(self._fd, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        self._shared = shared
+        return self
+
+    def release(self) -> None:
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def __enter__(self) -> Self:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.release()
+
+
 @dataclasses.dataclass(frozen=True)
 class ZilchProject:
     """In-memory representation of the data in the project-local store.
@@ -67,18 +244,45 @@ class ZilchProject:
     - The Python representation is necessary for actually operating on the objects.
     - The TOML representation is necessary to support round-tripping (especially TOML comments).
     Another possible design would be to only hold the TOML copy in memory, and write the Python objects as @propery's.
-    Whether we switch to that design or not, callers of this class will not care."""
-    toml_doc: tomlkit.toml_document.TOMLDocument
+    Whether we switch to that design or not, callers of this class will not care.
+
+    Packages are keyed by (source alias, package name), in the same order as the TOML array.
+
+    Read-only projects are usually loaded from a snapshot of the Python objects (see `_load_snapshot`),
+    in which case the TOML is only parsed if `toml_doc` is used."""
+    _toml_doc: tomlkit.toml_document.TOMLDocument | None
     toml_path: pathlib.Path
     version: tuple[int, ...]
     resource_path: pathlib.Path
     sources: dict[str, NixSource]
-    packages: list[NixPackage]
+    packages: dict[tuple[str, str], NixPackage]
+    read_only: bool = False
+    # Whether to pin the sources in a project-local flake registry (see `registry_path`)
+    registry: bool = False
+    # Sources added to `self.sources` but not yet to the TOML, because their rev is still being looked up
+    _new_sources: list[NixSource] = dataclasses.field(default_factory=list, compare=False, repr=False)
+    # One entry per open `transaction` (a list, because the dataclass is frozen)
+    _transactions: list[None] = dataclasses.field(default_factory=list, compare=False, repr=False)
+    # Index of each package in the TOML array, as it was before the removals in `_removed_positions`
+    # (see `_package_position`), so that removing a package does not renumber the others
+    _package_positions: dict[tuple[str, str], int] = dataclasses.field(default_factory=dict, compare=False, repr=False)
+    # Sorted indices (in the numbering of `_package_positions`) of the packages removed since it was built
+    _removed_positions: list[int] = dataclasses.field(default_factory=list, compare=False, repr=False)
+    # Packages added since the TOML was last validated; only these are checked before writing it
+    _added_packages: set[tuple[str, str]] = dataclasses.field(default_factory=set, compare=False, repr=False)
+    # Keys of the packages with each name, and the number of packages from each source,
+    # so that adding or removing a package does not scan the others (see `add_package` and `_source_used`)
+    _package_keys_by_name: dict[str, set[tuple[str, str]]] = dataclasses.field(default_factory=dict, compare=False, repr=False)
+    _source_package_counts: dict[str, int] = dataclasses.field(default_factory=dict, compare=False, repr=False)
 
-    @staticmethod
-    def from_path(toml_path: pathlib.Path | None) -> ZilchProject:
-        """Initializes a Zilch project from a path/to/zilch.toml or path/to/dir containing zilch.toml"""
+    def __post_init__(self) -> None:
+        self._reindex_packages()
+        for key in self.packages:
+            self._index_package(key)
 
+    @staticmethod
+    def find_toml_path(toml_path: pathlib.Path | None) -> pathlib.Path:
+        """Finds the path/to/zilch.toml from an explicit path, $ZILCH_PATH, the CWD, or the user-global scope (in that order)"""
         if toml_path is None:
             if "ZILCH_PATH" in os.environ:
                 toml_path = pathlib.Path(os.environ["ZILCH_PATH"])
@@ -90,13 +294,67 @@ class ZilchProject:
         if toml_path.is_dir():
             toml_path = toml_path / "zilch.toml"
 
-        # TODO: nice error handling when toml can't be created
-        toml_path.parent.mkdir(exist_ok=True, parents=True)
+        # Absolute, since the default resource path and the lock are named after it
+        return toml_path.absolute()
+
+    @functools.cached_property
+    def toml_doc(self) -> tomlkit.toml_document.TOMLDocument:
+        if self._toml_doc is not None:
+            return self._toml_doc
+        import tomlkit
+        with tracing.phase("parse toml"):
+            return tomlkit.parse(self.toml_path.read_text() if self.toml_path.exists() else "")
+
+    @staticmethod
+    def state_path(toml_path: pathlib.Path, suffix: str) -> pathlib.Path:
+        """A file for the project whose zilch.toml is at `toml_path`, in the data directory.
+
+        For state that is needed before the zilch.toml (and so the resource path) is read."""
+        import urllib.parse
+        return DEFAULT_DATA_PATH / f"{urllib.parse.quote(str(toml_path.parent), safe='')}{suffix}"
+
+    @staticmethod
+    def from_path(
+            toml_path: pathlib.Path | None,
+            read_only: bool = False,
+            lock_new_sources: bool = True,
+    ) -> ZilchProject:
+        """Initializes a Zilch project from a path/to/zilch.toml or path/to/dir containing zilch.toml
+
+        A `read_only` project is loaded without creating, locking, or writing anything (besides its snapshot).
+        If the TOML has no sources, it gets the default source without a rev rather than locking one.
+        It cannot be synced.
+
+        Unless `lock_new_sources`, the default source that a TOML without sources gets is left pending (in `_new_sources`),
+        for the caller to give it a rev (e.g. `zilch.batch`, which looks up each URL once for many projects)."""
+
+        toml_path = ZilchProject.find_toml_path(toml_path)
+        if read_only:
+            project = ZilchProject._load_snapshot(toml_path)
+            if project is not None:
+                return project
+
+        import urllib.parse
+
+        import tomlkit
 
         # Parse TOML
-        if not toml_path.exists():
-            toml_path.write_text("")
-        toml_doc = tomlkit.parse(toml_path.read_text())
+        snapshot_key = None
+        if read_only:
+            toml_text = ""
+            if toml_path.exists():
+                toml_text, snapshot_key = ZilchProject._read_toml(toml_path)
+        else:
+            # TODO: nice error handling when toml can't be created
+            toml_path.parent.mkdir(exist_ok=True, parents=True)
+            if not toml_path.exists():
+                toml_path.write_text("")
+            toml_text = toml_path.read_text()
+        with tracing.phase("parse toml"):
+            try:
+                toml_doc = tomlkit.parse(toml_text)
+            except tomlkit.exceptions.ParseError as exc:
+                raise ZilchTomlError(f"{toml_path} is not valid TOML: {exc}") from exc
 
         # Parse version
         version = tuple(map(
@@ -105,20 +363,28 @@ class ZilchProject:
         ))
 
         # Parse resource path
-        default_resource_path = pathlib.Path("/").joinpath(
-            platformdirs.user_data_dir(),
-            "zilch",
-            urllib.parse.quote(str(toml_path.parent), safe=""),
-        )
+        default_resource_path = DEFAULT_DATA_PATH / urllib.parse.quote(str(toml_path.parent), safe="")
         resource_path = pathlib.Path(toml_doc.get("resource_path", str(default_resource_path)))
-        resource_path.mkdir(exist_ok=True, parents=True)
+        if not read_only:
+            resource_path.mkdir(exist_ok=True, parents=True)
+
+        # Parse registry
+        registry = toml_doc.get("registry", False)
+        if not isinstance(registry, bool):
+            raise ZilchTomlError("registry should be true or false")
 
         # Parse and validate sources
         no_sources = "sources" not in toml_doc
-        sources_list = [
-            NixSource(source["url"], source["alias"], source["rev"])
-            for source in toml_doc.setdefault("sources", tomlkit.aot())
-        ]
+        try:
+            sources_list = [
+                NixSource(source["url"], source["alias"], source["rev"], {
+                    str(name): str(alias)
+                    for name, alias in source.get("follows", {}).items()
+                })
+                for source in toml_doc.setdefault("sources", tomlkit.aot())
+            ]
+        except tomlkit.exceptions.NonExistentKey as exc:
+            raise ZilchTomlError(f"A source in {toml_path} is missing a key: {exc}") from exc
         if len(sources_list) != len(set(map(lambda source: source.alias, sources_list))):
             raise ZilchTomlError(
                 "Some sources in the TOML have the same name"
@@ -127,27 +393,32 @@ class ZilchProject:
             source.alias: source
             for source in sources_list
         }
+        for source in sources_list:
+            for name, alias in source.follows.items():
+                if (alias not in sources and alias != "flake-utils") or alias == source.alias:
+                    raise ZilchTomlError(
+                        f"Input {name} of source {source.alias} follows {alias}, which is not another source"
+                    )
 
-        packages: list[NixPackage] = []
-        for package in toml_doc.setdefault("packages", tomlkit.aot()):
+        # Parse, validate, and deduplicate packages
+        packages: dict[tuple[str, str], NixPackage] = {}
+        toml_packages = toml_doc.setdefault("packages", tomlkit.aot())
+        duplicates = []
+        for i, package in enumerate(toml_packages):
+            if "source" not in package or "name" not in package:
+                raise ZilchTomlError(f"Package {package} in {toml_path} should have a name and a source")
             if package["source"] not in sources:
                 raise ZilchTomlError(
                     f"Package source of {package} is not in sources section"
                 )
-            packages.append(NixPackage(
-                f"legacyPackages.{get_system()}.{package['name']}",
-                sources[package["source"]],
-            ))
-
-        # Deduplicate packages
-        for i in range(len(packages)):
-            if i >= len(packages):
-                break
-            for j in range(i + 1, len(packages)):
-                if packages[i] == packages[j]:
-                    del packages[j]
-                    del expect_type(TomlAoT, toml_doc["packages"])[j]
-                    print("Removing duplicate", packages[j])
+            key = (str(package["source"]), str(package["name"]))
+            if key in packages:
+                print("Removing duplicate", packages[key], file=sys.stderr)
+                duplicates.append(i)
+            else:
+                packages[key] = NixPackage(key[1], sources[key[0]])
+        for i in reversed(duplicates):
+            del toml_packages[i]
 
         project = ZilchProject(
             toml_doc,
@@ -156,52 +427,193 @@ class ZilchProject:
             resource_path,
             sources,
             packages,
+            read_only,
+            registry,
         )
-        if no_sources:
-            project.add_source(DEFAULT_SOURCE)
-        project._validate()
+        with tracing.phase("validate"):
+            project._validate()
+        if no_sources and not read_only:
+            project.add_source(dataclasses.replace(DEFAULT_SOURCE), lock=lock_new_sources)
+        if no_sources and read_only:
+            project.sources[DEFAULT_SOURCE.alias] = dataclasses.replace(DEFAULT_SOURCE)
+        if snapshot_key is not None:
+            project._write_snapshot(snapshot_key)
         return project
 
+    @staticmethod
+    def _read_toml(toml_path: pathlib.Path) -> tuple[str, dict[str, typing.Any]]:
+        """The text of the zilch.toml, and the key of a snapshot of it: its mtime, size, and hash"""
+        # Stat before reading, so that a concurrent change makes the key stale rather than the snapshot
+        stat = toml_path.stat()
+        data = toml_path.read_bytes()
+        return data.decode(), {
+            "mtime_ns": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "sha256": hashlib.sha256(data).hexdigest(),
+        }
+
+    def _write_snapshot(self, key: dict[str, typing.Any]) -> None:
+        """Saves the parsed project for `_load_snapshot`"""
+        snapshot = {
+            "format": SNAPSHOT_FORMAT,
+            "key": key,
+            "version": self.version,
+            "resource_path": str(self.resource_path),
+            "registry": self.registry,
+            "sources": [dataclasses.asdict(source) for source in self.sources.values()],
+            "packages": list(self.packages),
+        }
+        snapshot_path = ZilchProject.state_path(self.toml_path, ".snapshot.json")
+        snapshot_path.parent.mkdir(exist_ok=True, parents=True)
+        write_atomic(snapshot_path, json.dumps(snapshot))
+
+    @staticmethod
+    def _load_snapshot(toml_path: pathlib.Path) -> ZilchProject | None:
+        """Loads a read-only project from its snapshot, without parsing the TOML, if the TOML has not changed since"""
+        with tracing.phase("load snapshot"):
+            try:
+                snapshot = json.loads(ZilchProject.state_path(toml_path, ".snapshot.json").read_text())
+                _, key = ZilchProject._read_toml(toml_path)
+            except (FileNotFoundError, json.JSONDecodeError):
+                return None
+            if snapshot.get("format") != SNAPSHOT_FORMAT or snapshot["key"] != key:
+                return None
+            sources = {
+                source["alias"]: NixSource(**source)
+                for source in snapshot["sources"]
+            }
+            return ZilchProject(
+                None,
+                toml_path,
+                tuple(snapshot["version"]),
+                pathlib.Path(snapshot["resource_path"]),
+                sources,
+                {
+                    (alias, name): NixPackage(name, sources[alias])
+                    for alias, name in snapshot["packages"]
+                },
+                True,
+                snapshot["registry"],
+            )
+
+    def _reindex_packages(self) -> None:
+        self._package_positions.clear()
+        self._package_positions.update((key, i) for i, key in enumerate(self.packages))
+        self._removed_positions.clear()
+        self._added_packages.clear()
+
+    def _index_package(self, key: tuple[str, str]) -> None:
+        alias, name = key
+        self._package_keys_by_name.setdefault(name, set()).add(key)
+        self._source_package_counts[alias] = self._source_package_counts.get(alias, 0) + 1
+
+    def _unindex_package(self, key: tuple[str, str]) -> None:
+        alias, name = key
+        self._package_keys_by_name[name].discard(key)
+        if not self._package_keys_by_name[name]:
+            del self._package_keys_by_name[name]
+        self._source_package_counts[alias] -= 1
+        if not self._source_package_counts[alias]:
+            del self._source_package_counts[alias]
+
+    def _package_position(self, key: tuple[str, str]) -> int:
+        """Index of the package in the TOML array"""
+        position = self._package_positions[key]
+        return position - bisect.bisect_left(self._removed_positions, position)
+
     # TODO: Use Deal to check this invariant before/after each method.
     # https://deal.readthedocs.io/index.html
-    def _validate(self) -> None:
+    def _validate(self, packages: typing.Iterable[tuple[str, str]] | None = None) -> None:
+        """Checks that the TOML matches the Python objects, for the given packages (default: every package)"""
         # Validate packages
-        toml_packages = expect_type(TomlAoT, self.toml_doc["packages"])
+        toml_packages = toml_aot(self.toml_doc, "packages")
         assert len(self.packages) == len(toml_packages)
-        for package, package_dict in zip(self.packages, toml_packages):
-            assert package.name == package_dict["name"]
-            assert package.source.alias == package_dict["source"]
+        for alias, name in self.packages if packages is None else packages:
+            package_dict = toml_packages[self._package_position((alias, name))]
+            assert alias == package_dict["source"]
+            assert name == package_dict["name"]
 
         # Validate sources
-        toml_sources = expect_type(TomlAoT, self.toml_doc["sources"])
+        toml_sources = toml_aot(self.toml_doc, "sources")
         assert len(self.sources) == len(toml_sources)
         for (alias, source), source_dict in zip(self.sources.items(), toml_sources):
             assert source.url == source_dict["url"]
             assert source.alias == source_dict["alias"] == alias
             assert source.rev == source_dict["rev"]
             assert source.rev is not None
+            assert source.follows == source_dict.get("follows", {})
 
     def _write_toml(self) -> None:
-        self._validate()
-        self.toml_path.write_text(tomlkit.dumps(self.toml_doc))
+        # Unchanged packages were validated when the project was loaded, and removals are covered by the length check
+        self._validate(key for key in self._added_packages if key in self.packages)
+        self._reindex_packages()
+        import tomlkit
+        with tracing.phase("write toml"):
+            text = tomlkit.dumps(self.toml_doc)
+            if not self.toml_path.exists() or self.toml_path.read_text() != text:
+                write_atomic(self.toml_path, text)
+                self._write_snapshot(ZilchProject._read_toml(self.toml_path)[1])
+
+    def _fingerprint(self) -> str:
+        """Hash of every input that determines the built zilch-env.
+
+        If this matches the fingerprint stored after the last successful build,
+        the flake, the lock, and the build are all still up-to-date."""
+        inputs = {
+            "system": get_system(),
+            "sources": [
+                [source.alias, source.url, source.rev, source.follows]
+                for source in self.sources.values()
+            ],
+            "packages": [
+                [package.source.alias, package.name]
+                for package in self.packages.values()
+            ],
+            "template": (root / "flake.nix.template").read_text(),
+            "registry": self.registry,
+        }
+        with tracing.phase("fingerprint"):
+            return hashlib.sha256(json.dumps(inputs, sort_keys=True).encode()).hexdigest()
+
+    def is_synced(self, fingerprint: str | None = None) -> bool:
+        """Whether the last successful build matches the current project"""
+        fingerprint_path = self.resource_path / "fingerprint"
+        return (
+            (self.resource_path / "result").exists()
+            and fingerprint_path.exists()
+            and fingerprint_path.read_text() == (fingerprint or self._fingerprint())
+        )
+
+    @property
+    def flake_path(self) -> pathlib.Path:
+        """Directory of the generated flake.
+
+        It holds only what the flake reads (flake.nix, flake.lock, and the package list),
+        since Nix copies the whole directory to the store and keys its evaluation cache on its contents."""
+        return self.resource_path / "flake"
 
     def _write_flake(self) -> None:
-        input_lines_with_rev = list(set(
-            f"{source.alias}.url = \"{source.url}{'?rev=' + source.rev if source.rev is not None else ''}\";"
-            for source in self.sources.values()
-        ))
-        input_lines = list(set(
-            f"{source.alias}.url = \"{source.url}\";"
+        # Sources are baked into the flake inputs; packages are read from `flake_path / "zilch.toml"` (see flake.nix.template).
+        # So package-only changes rewrite just that file and reuse the lock.
+        input_lines_with_rev = [
+            line
             for source in self.sources.values()
-        ))
-        package_lines = [
-            f"inputs.{package.source.alias}.legacyPackages.${{system}}.{package.name}"
-            for package in self.packages
+            for line in [f"{source.alias}.url = \"{source.locked_url}\";", *source.follows_lines]
         ]
-        name_equals_package_lines = [
-            f"{package.source.alias}-{package.name} = inputs.{package.source.alias}.legacyPackages.${{system}}.{package.name};"
-            for package in self.packages
+        input_lines = [
+            line
+            for source in self.sources.values()
+            for line in [f"{source.alias}.url = \"{source.url}\";", *source.follows_lines]
         ]
+        import tomlkit
+        self.flake_path.mkdir(exist_ok=True)
+        with tracing.phase("render flake"):
+            write_atomic(self.flake_path / "zilch.toml", tomlkit.dumps({
+                "packages": [
+                    {"name": package.name, "source": package.source.alias}
+                    for package in self.packages.values()
+                ],
+            }))
         # Note: In order to get the flake at the locked rev,
         # We will write the `flake.nix` with rev hardcoded, call `nix flake lock`, and then write the `flake.nix` with no rev hardcoded.
         # This ensures the `flake.lock` has the right rev, but also the rev should not appear in `flake.nix`, so that `nix flake update` will work
@@ -209,60 +621,104 @@ class ZilchProject:
         # However, I don't know how to compute the narHash, so I will do this instead.
         # I also think that flake.lock is technically not part of the "public interface" of flakes, so it might change its format.
         # I don't think Nix developers intend users to set that directly.
-        (self.resource_path / "flake.nix").write_text(
-            (root / "flake.nix.template")
-            .read_text()
-            .replace("INPUTS_HERE", ("\n" + 4 * " ").join(input_lines_with_rev)) # NOT input_lines
-            .replace("PACKAGES_HERE", ("\n" + 14 * " ").join(package_lines))
-            .replace("NAME_EQUALS_PACKAGE_HERE", ("\n" + 10 * " ").join(name_equals_package_lines))
-        )
-        NixFlake.lock(self.resource_path)
-        (self.resource_path / "flake.nix").write_text(
-            (root / "flake.nix.template")
-            .read_text()
-            .replace("INPUTS_HERE", ("\n" + 4 * " ").join(input_lines)) # NOT input_lines_with_rev
-            .replace("PACKAGES_HERE", ("\n" + 14 * " ").join(package_lines))
-            .replace("NAME_EQUALS_PACKAGE_HERE", ("\n" + 10 * " ").join(name_equals_package_lines))
-        )
+        # The lock is skipped when the inputs are unchanged and it pins exactly the sources at their revs
+        # (e.g. just after `_lock_new_sources`).
+        flake = (root / "flake.nix.template").read_text().replace("INPUTS_HERE", ("\n" + 4 * " ").join(input_lines))
+        flake_nix_path = self.flake_path / "flake.nix"
+        locked_revs = NixFlake.locked_revs(self.flake_path)
+        locked_revs.pop("flake-utils", None)
+        if (
+            not flake_nix_path.exists()
+            or flake_nix_path.read_text() != flake
+            or locked_revs != {alias: source.rev for alias, source in self.sources.items()}
+        ):
+            with tracing.phase("render flake"):
+                write_atomic(
+                    flake_nix_path,
+                    (root / "flake.nix.template")
+                    .read_text()
+                    .replace("INPUTS_HERE", ("\n" + 4 * " ").join(input_lines_with_rev)) # NOT input_lines
+                )
+            NixFlake.lock(self.flake_path)
+        write_atomic(flake_nix_path, flake) # NOT input_lines_with_rev
+
+    def add_source(self, source: NixSource, lock: bool = True) -> None:
+        """Adds the source; if it has no rev, looks up the current one.
 
-    def add_source(self, source: NixSource) -> None:
+        In a `transaction`, the lookup is deferred to the end of the transaction.
+        Unless `lock`, the source is left pending (in `_new_sources`) for the caller to call `_lock_new_sources`."""
         if source.alias in self.sources:
             raise ZilchError(
                 f"Cannot add {source.alias}: "
                 "A source with that alias already exists"
             )
-        if source.rev is None:
-            self.sources[source.alias] = source
+        for name, alias in source.follows.items():
+            if (alias not in self.sources and alias != "flake-utils") or alias == source.alias:
+                raise ZilchError(
+                    f"Cannot add {source.alias}: "
+                    f"Its input {name} follows {alias}, which is not another source"
+                )
+        self.sources[source.alias] = source
+        self._new_sources.append(source)
+        if lock and not self._transactions:
+            self._lock_new_sources()
+
+    def _lock_new_sources(self) -> None:
+        """Looks up the revs of every new source in one `nix flake lock`, then adds them to the TOML"""
+        import tomlkit
+        if any(source.rev is None for source in self._new_sources):
             self._write_flake()
-            rev = NixFlake.get_rev(self.resource_path, source.alias)
-            source.rev = rev
-            expect_type(TomlAoT, self.toml_doc["sources"]).append({
+            locked_revs = NixFlake.locked_revs(self.flake_path)
+            for source in self._new_sources:
+                if source.rev is None:
+                    source.rev = locked_revs[source.alias]
+        # New sources are added in order, so that the TOML array stays in the same order as self.sources
+        for source in self._new_sources:
+            source_dict: dict[str, typing.Any] = {
                 "url": source.url,
                 "alias": source.alias,
                 "rev": source.rev,
-            })
-        else:
-            self.sources[source.alias] = source
-            expect_type(TomlAoT, self.toml_doc["sources"]).append({
-                "url": source.url,
-                "alias": source.alias,
-                "rev": source.rev,
-            })
+            }
+            if source.follows:
+                follows = tomlkit.inline_table()
+                follows.update(source.follows)
+                source_dict["follows"] = follows
+            toml_aot(self.toml_doc, "sources").append(source_dict)
+        self._new_sources.clear()
 
     def remove_source(self, source_alias) -> None:
         if source_alias not in self.sources:
             raise ZilchError(
-                f"Cannot remove {source_alias.alias}: "
+                f"Cannot remove {source_alias}: "
                 "No source with that alias exists"
             )
-        del self.sources[source_alias]
-        toml_sources = expect_type(TomlAoT, self.toml_doc["sources"])
+        source = self.sources.pop(source_alias)
+        if source in self._new_sources:
+            self._new_sources.remove(source)
+            return
+        toml_sources = toml_aot(self.toml_doc, "sources")
         for i in range(len(toml_sources)):
             if toml_sources[i]["alias"] == source_alias:
                 del toml_sources[i]
                 break
 
-    def add_package(self, package: NixPackage) -> None:
+    def add_package(self, package: NixPackage, replace: bool = False) -> None:
+        """Adds the package (and its source, if the project does not have it yet).
+
+        Only one version of a package can be added: the same name from another rev of the same source URL
+        (e.g. a version pinned with `pin_version`) would provide the same files, which collide in the environment.
+        If `replace`, such other versions are removed (see `remove_package`); otherwise, adding the package fails."""
+        others = [
+            self.packages[other_key]
+            for other_key in self._package_keys_by_name.get(package.name, ())
+            if other_key[0] != package.source.alias
+            and self.packages[other_key].source.url == package.source.url
+        ]
+        if others and not replace:
+            raise ZilchError(
+                f"Cannot add {package.name} from {package.source.alias}: "
+                f"It is already added from {', '.join(other.source.alias for other in others)} (another rev of {package.source.url})"
+            )
         if package.source.alias in self.sources:
             if package.source != self.sources[package.source.alias]:
                 raise ZilchError(
@@ -271,134 +727,565 @@ class ZilchProject:
                 )
         else:
             self.add_source(package.source)
-        for existing_package in self.packages:
-            if existing_package == package:
-                raise ZilchError(
-                    f"Cannot add {package.name}: Already installed"
-                )
-        self.packages.append(package)
-        expect_type(TomlAoT, self.toml_doc["packages"]).append({
+        key = (package.source.alias, package.name)
+        if key in self.packages:
+            raise ZilchError(
+                f"Cannot add {package.name}: Already installed"
+            )
+        for other in others:
+            self.remove_package(other, any_source=False)
+        toml_packages = toml_aot(self.toml_doc, "packages")
+        self.packages[key] = package
+        self._index_package(key)
+        # Numbered after every package, removed or not (see `_package_position`)
+        self._package_positions[key] = len(toml_packages) + len(self._removed_positions)
+        self._added_packages.add(key)
+        toml_packages.append({
             "name": package.name,
             "source": package.source.alias,
         })
 
-    def _get_package(self, package: NixPackage, any_source: bool) -> tuple[NixPackage, int]:
-        for i, existing_package in enumerate(self.packages):
-            if (existing_package.name == package.name
-                and (any_source or package.source.alias == existing_package.source.alias)):
-                return (package, i)
-        raise KeyError()
+    def _source_used(self, source_alias: str) -> bool:
+        """Whether the source is the default one (which the flake builds the environment with),
+        or a package comes from it, or another source follows it"""
+        return (
+            source_alias == DEFAULT_SOURCE.alias
+            or source_alias in self._source_package_counts
+            or any(source_alias in source.follows.values() for source in self.sources.values())
+        )
+
+    def pin_version(self, package: NixPackage, version: str) -> NixPackage:
+        """The package from a rev of its source at which it has `version`.
+
+        That is its source if the version matches already;
+        otherwise a source of the same URL at an older rev (reusing one of the project's sources at that rev, if any).
+        See zilch.versions for how the rev is found."""
+        from .versions import find_rev
+        rev = find_rev(package, version)
+        if rev == package.source.rev:
+            return dataclasses.replace(package, version=version)
+        for source in self.sources.values():
+            if source.url == package.source.url and source.rev == rev:
+                break
+        else:
+            source = NixSource(package.source.url, f"{package.source.alias}-{rev[:8]}", rev, dict(package.source.follows))
+        return dataclasses.replace(package, source=source, version=version)
+
+    def _get_packages(self, package: NixPackage, any_source: bool) -> list[NixPackage]:
+        """Added packages with the same name, from the same source unless `any_source`"""
+        aliases = self.sources if any_source else [package.source.alias]
+        return [
+            self.packages[(alias, package.name)]
+            for alias in aliases
+            if (alias, package.name) in self.packages
+        ]
 
     def remove_package(self, package: NixPackage, any_source: bool) -> None:
-        try:
-            _, i = self._get_package(package, any_source)
-        except KeyError:
+        """Removes the package; if `any_source`, removes the packages with this name from every source.
+
+        A source that is no longer used (see `_source_used`), e.g. a version pinned with `pin_version`, is removed too,
+        so that it is not fetched and locked on every sync."""
+        existing_packages = self._get_packages(package, any_source)
+        if not existing_packages:
             raise ZilchError(
                 f"Cannot remove {package.name}{' (any source)' if any_source else ''}: "
                 f"{package} not added"
             )
-        else:
-            del self.packages[i]
-            del expect_type(TomlAoT, self.toml_doc["packages"])[i]
+        for existing_package in existing_packages:
+            key = (existing_package.source.alias, existing_package.name)
+            i = self._package_position(key)
+            del self.packages[key]
+            del toml_aot(self.toml_doc, "packages")[i]
+            bisect.insort(self._removed_positions, self._package_positions.pop(key))
+            self._unindex_package(key)
+            if not self._source_used(existing_package.source.alias):
+                self.remove_source(existing_package.source.alias)
 
     def status(self, package: NixPackage, any_source: bool) -> str:
         try:
-            package, i = self._get_package(package, any_source)
-        except KeyError:
+            package = self._get_packages(package, any_source)[0]
+        except IndexError:
             return "Not added"
         else:
-            attr = f"{package.source.alias}-{package.name}"
-            if NixFlake.get_store_path(self.resource_path, attr).exists():
+            if self.installed([package]) == [True]:
                 return f"Added from {package.source} & installed"
             else:
                 return f"Added from {package.source} but not installed"
 
-    def autoremove(self) -> None:
-        subprocess.run(
-            ["nix", "store", "gc"],
-            check=True,
-            capture_output=False,
-            # This output can get propagated to the user
-        )
+    def installed(self, packages: typing.Sequence[NixPackage] | None = None) -> list[bool]:
+        """Whether each package (default: every package in the project) is installed.
+
+        All store paths are evaluated in a single `nix eval`, then checked for existence in parallel."""
+        if packages is None:
+            packages = list(self.packages.values())
+        if not packages or not (self.flake_path / "flake.nix").exists():
+            return [False] * len(packages)
+        attrs = [f"{package.source.alias}-{package.name}" for package in packages]
+        import concurrent.futures
+        store_paths = NixFlake.get_store_paths(self.flake_path, attrs)
+
+        def is_installed(attr: str) -> bool:
+            store_path = store_paths.get(attr)
+            return store_path is not None and store_path.exists()
+
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            return list(executor.map(is_installed, attrs))
+
+    def generations(self) -> list[int]:
+        """Numbers of the generations (successful syncs) that are still around, oldest first"""
+        generations_path = self.resource_path / "generations"
+        if not generations_path.exists():
+            return []
+        return sorted(int(path.name) for path in generations_path.iterdir() if path.name.isdigit())
+
+    def generation_path(self, generation: int) -> pathlib.Path:
+        """Directory with the environment of a generation (its `result` link, which is also its GC root)
+        and copies of everything that describes it (zilch.toml, the flake, the fingerprint, and the registry)"""
+        return self.resource_path / "generations" / str(generation)
+
+    def current_generation(self) -> int | None:
+        """The generation that `result` points to"""
+        result = self.resource_path / "result"
+        if not result.is_symlink():
+            return None
+        parts = pathlib.Path(os.readlink(result)).parts
+        if len(parts) == 3 and parts[0] == "generations" and parts[1].isdigit():
+            return int(parts[1])
+        # Built before generations existed
+        return None
+
+    def _activate(self, generation: int, fingerprint: str) -> None:
+        """Points `result` at the generation; the symlink is replaced atomically"""
+        import tempfile
+        result = self.resource_path / "result"
+        # Made in a fresh directory next to `result`, so that concurrent syncs never share the temporary link
+        with tempfile.TemporaryDirectory(dir=self.resource_path, prefix=".result.") as tmp_dir:
+            tmp_link = pathlib.Path(tmp_dir, result.name)
+            # Relative, so it resolves the same once moved
+            tmp_link.symlink_to(pathlib.Path("generations", str(generation), "result"))
+            os.replace(tmp_link, result)
+        write_atomic(self.resource_path / "fingerprint", fingerprint)
+
+    def switch_generation(self, generation: int) -> None:
+        """Makes an earlier (or later) generation current, without evaluating or building anything.
+
+        zilch.toml and the flake are restored to what they were for that generation.
+        The project should be loaded again afterwards."""
+        if self.read_only:
+            raise ZilchError("Cannot switch generations of a project that was loaded read-only")
+        generation_path = self.generation_path(generation)
+        if not (generation_path / "result").exists():
+            raise ZilchError(f"No generation {generation}")
+        (self.resource_path / "fingerprint").unlink(missing_ok=True)
+        write_atomic(self.toml_path, (generation_path / "zilch.toml").read_text())
+        self.flake_path.mkdir(exist_ok=True)
+        for file in (generation_path / "flake").iterdir():
+            write_atomic(self.flake_path / file.name, file.read_text())
+        if (generation_path / "registry.json").exists():
+            write_atomic(self.registry_path, (generation_path / "registry.json").read_text())
+        else:
+            self.registry_path.unlink(missing_ok=True)
+        self._activate(generation, (generation_path / "fingerprint").read_text())
+
+    def rollback(self) -> int:
+        """Switches to the generation before the current one, and returns its number"""
+        current = self.current_generation()
+        earlier = [
+            generation
+            for generation in self.generations()
+            if current is None or generation < current
+        ]
+        if not earlier:
+            raise ZilchError("No earlier generation to roll back to")
+        self.switch_generation(earlier[-1])
+        return earlier[-1]
+
+    def autoremove(self, dry_run: bool = False, newer: bool = False) -> tuple[list[pathlib.Path], int]:
+        """Deletes the generations before the current one, and the store paths that only they used.
+
+        Generations after the current one (left by a `rollback`) are kept, unless `newer`.
+        Unlike `nix store gc`, this never scans the whole store: it only considers the closure difference
+        between the environments of the deleted generations and the kept ones.
+        Paths that are still alive for another reason (e.g. another project or a profile uses them) are kept.
+
+        Returns the paths that were (or, if `dry_run`, would be) deleted and their total size in bytes.
+        A dry run cannot tell which paths are alive for another reason, so it overestimates."""
+        current = self.current_generation()
+        old_generations = [
+            generation
+            for generation in self.generations()
+            if generation != current and (newer or current is None or generation < current)
+        ]
+        old_generation_paths = [self.generation_path(generation) for generation in old_generations]
+        old_envs = [
+            (path / "result").resolve()
+            for path in old_generation_paths
+            if (path / "result").exists()
+        ]
+        garbage: dict[pathlib.Path, int] = {}
+        if old_envs:
+            old_closure = NixFlake.closure(old_envs)
+            kept_results = [
+                self.resource_path / "result",
+                *(self.generation_path(generation) / "result" for generation in self.generations() if generation not in old_generations),
+            ]
+            kept_envs = [result.resolve() for result in kept_results if result.exists()]
+            kept_closure = NixFlake.closure(kept_envs) if kept_envs else {}
+            garbage = {
+                path: size
+                for path, size in old_closure.items()
+                if path not in kept_closure
+            }
+        if not dry_run:
+            import shutil
+            # Their `result` links are GC roots
+            for path in old_generation_paths:
+                shutil.rmtree(path)
+            NixFlake.delete(list(garbage))
+            garbage = {path: size for path, size in garbage.items() if not path.exists()}
+        return sorted(garbage), sum(garbage.values())
 
     def sync(self) -> None:
+        """Builds the project as a new generation and makes it current, unless it is already up-to-date"""
+        fingerprint = self._prepare_sync()
+        if fingerprint is not None:
+            self._build_generation(fingerprint, self.flake_ref)
+
+    @property
+    def flake_ref(self) -> str:
+        """The installable of the project's environment"""
+        return f"path:{self.flake_path}#zilch-env"
+
+    def _prepare_sync(self) -> str | None:
+        """Writes the TOML and flake to build; returns the fingerprint to build, or None if the project is up-to-date"""
+        if self.read_only:
+            raise ZilchError("Cannot sync a project that was loaded read-only")
         self._write_toml()
+        fingerprint = self._fingerprint()
+        if self.is_synced(fingerprint):
+            return None
+        # Remove the old fingerprint first, so a failed build is not mistaken for a successful one
+        (self.resource_path / "fingerprint").unlink(missing_ok=True)
         self._write_flake()
-        NixFlake.build(self.resource_path, ".#zilch-env")
+        return fingerprint
+
+    def _build_generation(self, fingerprint: str, installable: str) -> None:
+        """Builds `installable` (the flake's environment, or its store path if that is already built)
+        as a new generation, and makes it current"""
+        import shutil
+        generation = max(self.generations(), default=0) + 1
+        generation_path = self.generation_path(generation)
+        generation_path.mkdir(parents=True)
+        try:
+            # Built from the resource path, so that `result` is next to (not in) the flake
+            NixFlake.build(
+                self.resource_path,
+                installable,
+                out_link=generation_path / "result",
+            )
+            self._write_registry()
+            shutil.copyfile(self.toml_path, generation_path / "zilch.toml")
+            shutil.copytree(self.flake_path, generation_path / "flake")
+            if self.registry_path.exists():
+                shutil.copyfile(self.registry_path, generation_path / "registry.json")
+            (generation_path / "fingerprint").write_text(fingerprint)
+        except BaseException:
+            shutil.rmtree(generation_path)
+            raise
+        self._activate(generation, fingerprint)
+
+    @contextlib.contextmanager
+    def transaction(self) -> typing.Iterator[ZilchProject]:
+        """Batches changes to the project, then syncs it once.
+
+        The revs of all sources added in the transaction are looked up in a single `nix flake lock` at the end,
+        which the sync then reuses, so the whole batch costs one lock and one build.
+        If the block raises, nothing is written to disk (but the project in memory is left partly changed).
+        Transactions can be nested; only the outermost one syncs."""
+        if self.read_only:
+            raise ZilchError("Cannot change a project that was loaded read-only")
+        self._transactions.append(None)
+        try:
+            yield self
+        finally:
+            self._transactions.pop()
+        if not self._transactions:
+            self._lock_new_sources()
+            self.sync()
+
+    @property
+    def registry_path(self) -> pathlib.Path:
+        """Flake registry pinning each source alias to the source at its rev, if `registry = true` in the TOML.
+
+        Inside `zilch shell`, it is Nix's global registry, so that e.g. `nix run nixpkgs#hello`
+        uses the same nixpkgs as the project (and hits the same evaluation cache) instead of fetching the latest."""
+        return self.resource_path / "registry.json"
 
-    def get_env_vars(self) -> typing.Mapping[str, str]:
-        return NixFlake.env_vars(self.resource_path, ".#zilch-env")
+    def _write_registry(self) -> None:
+        registry_path = self.registry_path
+        if not self.registry:
+            registry_path.unlink(missing_ok=True)
+            return
+        import tempfile
+        # Written in a fresh directory next to the registry and moved into place,
+        # so readers never see a partial registry, and concurrent syncs never share the temporary file
+        with tempfile.TemporaryDirectory(dir=registry_path.parent, prefix=f".{registry_path.name}.") as tmp_dir:
+            tmp_path = pathlib.Path(tmp_dir, registry_path.name)
+            for source in self.sources.values():
+                NixFlake.registry_add(tmp_path, source.alias, source.locked_url)
+            os.replace(tmp_path, registry_path)
+
+    def get_env_vars(self, outer_env: typing.Mapping[str, str] | None = None) -> typing.Mapping[str, str]:
+        """The variables to set in `outer_env` (default: this process's environment) to enter the project's environment"""
+        outer_env = dict(os.environ) if outer_env is None else outer_env
+        # The environment's store path, which (unlike the flake) needs no evaluation
+        env_vars = NixFlake.env_vars(self.resource_path, str((self.resource_path / "result").resolve()), outer_env)
+        if self.registry:
+            nix_config = env_vars.get("NIX_CONFIG", outer_env.get("NIX_CONFIG"))
+            return {
+                **env_vars,
+                "NIX_CONFIG": "\n".join(filter(None, [nix_config, f"flake-registry = {self.registry_path}"])),
+            }
+        return env_vars
+
+    def search(
+            self,
+            source: NixSource,
+            terms: typing.Sequence[str],
+            limit: int | None = None,
+    ) -> typing.Iterable[NixPackage]:
+        """Search the packages of a source.
+
+        Locked sources are searched through an on-disk index of the whole source at that rev,
+        which is built with a single `nix search` the first time the source is searched."""
+        if source.rev is None:
+            return NixFlake.search(source, terms, limit)
+        from .index import SearchIndex
+        index = SearchIndex.for_source(self.resource_path, source)
+        if not index.exists():
+            with tracing.phase("build search index", source=source.alias):
+                index.build(NixFlake.search(source, ["^"]))
+        return index.search(source, terms, limit)
+
+    def check_package(self, package: NixPackage) -> None:
+        """Raises a ZilchError, suggesting similar names, if the package's source has no such package.
+
+        The names of a locked source are fetched once (with a single `nix eval` of its attribute names)
+        and kept in an on-disk index of that rev.
+        Only the first component of attribute paths (e.g. python3Packages in python3Packages.numpy) is checked,
+        and packages of unlocked sources are not checked."""
+        if package.source.rev is None or package.family != "legacyPackages":
+            return
+        from .index import NameIndex
+        index = NameIndex.for_source(self.resource_path, package.source)
+        if not index.exists():
+            with tracing.phase("build name index", source=package.source.alias):
+                index.build(NixFlake.attr_names(package.source))
+        top_level = package.name.partition(".")[0]
+        if top_level not in index:
+            suggestions = index.suggest(top_level)
+            raise ZilchError(
+                f"Cannot add {package.name}: {package.source.alias} has no package {top_level}"
+                + (f"; did you mean {', '.join(suggestions)}?" if suggestions else "")
+            )
+
+    def search_many(
+            self,
+            sources: typing.Iterable[NixSource],
+            terms: typing.Sequence[str],
+            limit: int | None = None,
+    ) -> typing.Iterator[tuple[NixSource, typing.Iterator[NixPackage]]]:
+        """Search several sources concurrently (see `MAX_NIX_JOBS`).
+
+        Yields each source with an iterator of its results as soon as the source has a first result (or none),
+        not in the given order. Results are passed on through a small queue per source as they are found,
+        so they are neither all built before the first is shown nor all held in memory."""
+        import concurrent.futures
+        import queue
+        sources = list(sources)
+        ready: queue.Queue[tuple[NixSource, queue.Queue[typing.Any]]] = queue.Queue()
+        stop = threading.Event()
+        end = object()
+
+        def put(results: queue.Queue[typing.Any], item: object) -> bool:
+            """Waits for room in the queue; False if the caller stopped reading"""
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce(source: NixSource) -> None:
+            if stop.is_set():
+                return
+            results: queue.Queue[typing.Any] = queue.Queue(maxsize=SEARCH_QUEUE_SIZE)
+            announced = False
+            try:
+                for package in self.search(source, terms, limit):
+                    if not announced:
+                        ready.put((source, results))
+                        announced = True
+                    if not put(results, package):
+                        return
+                item: object = end
+            except Exception as exc:
+                item = exc
+            if not announced:
+                ready.put((source, results))
+            put(results, item)
+
+        def consume(results: queue.Queue[typing.Any]) -> typing.Iterator[NixPackage]:
+            while True:
+                item = results.get()
+                if item is end:
+                    return
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_NIX_JOBS) as executor:
+            for source in sources:
+                executor.submit(produce, source)
+            try:
+                for _ in sources:
+                    source, results = ready.get()
+                    yield source, consume(results)
+            finally:
+                # Lets the searches that are still running (or not yet started) end early, if the caller stops reading
+                stop.set()
 
 
 @dataclasses.dataclass
 class NixPackage:
-    """A uniquely identified package."""
-    attribute: str
+    """A uniquely identified package.
+
+    The system is only looked up (see `get_system`) when the full attribute is needed."""
+    name: str
     source: NixSource
     version: str | None = None
     description: str | None = None
+    family: str = "legacyPackages"
+    _system: str | None = dataclasses.field(default=None, compare=False, repr=False)
 
     @staticmethod
     def from_name(name: str, source: NixSource) -> NixPackage:
-        return NixPackage(
-            f"legacyPackages.{get_system()}.{name}",
-            source,
-            None,
-        )
+        return NixPackage(name, source)
 
-    @property
-    def family(self) -> str:
-        """Attribute family.  e.g legacyPackages"""
-        return self.attribute.split('.', 2)[0]
+    @staticmethod
+    def from_attribute(
+            attribute: str,
+            source: NixSource,
+            version: str | None = None,
+            description: str | None = None,
+    ) -> NixPackage:
+        family, system, name = parse_attrpath(attribute)
+        return NixPackage(name, source, version, description, family, system)
 
     @property
     def system(self) -> str:
         """Architecture and OS"""
-        return self.attribute.split('.', 2)[1]
+        if self._system is None:
+            self._system = get_system()
+        return self._system
 
     @property
-    def name(self) -> str:
-        """Package name"""
-        return self.attribute.split('.', 2)[2]
+    def attribute(self) -> str:
+        """Attribute path, e.g. legacyPackages.x86_64-linux.hello"""
+        return f"{self.family}.{self.system}.{self.name}"
 
 
 @dataclasses.dataclass
 class NixSource:
-    """Nix package source, at a specific revision."""
+    """Nix package source, at a specific revision.
+
+    `follows` maps inputs of the source's flake to other sources (by alias) that should be used instead,
+    so that e.g. several nixpkgs-based sources share one nixpkgs rather than each fetching and evaluating its own.
+    In zilch.toml: `follows = { nixpkgs = "nixpkgs" }`."""
     url: str
     alias: str
     rev: str | None
+    follows: dict[str, str] = dataclasses.field(default_factory=dict)
+
+    @property
+    def follows_lines(self) -> list[str]:
+        """Flake input lines for `follows`"""
+        return [
+            f"{self.alias}.inputs.{name}.follows = \"{alias}\";"
+            for name, alias in self.follows.items()
+        ]
+
+    @property
+    def locked_url(self) -> str:
+        """Flake URL pinned to `rev` (if it is known)"""
+        if self.rev is None:
+            return self.url
+        return f"{self.url}{'&' if '?' in self.url else '?'}rev={self.rev}"
 
 
 class NixFlake:
     """A wrapper around a Nix Flake"""
 
     @staticmethod
-    def env_vars(path: pathlib.Path, pkg: str) -> typing.Mapping[str, str]:
-        """Returns the environment variables that turn a shell into a Nix shell"""
+    def env_vars(
+            path: pathlib.Path,
+            pkg: str,
+            outer_env: typing.Mapping[str, str] | None = None,
+    ) -> typing.Mapping[str, str]:
+        """Returns the environment variables that turn a shell with `outer_env` (default: this process's) into a Nix shell
+
+        The result is cached in `path`, keyed by the store path that `path/result` points to
+        and by the outer values of every variable in the result.
+        The last few store paths are kept, so that switching back to an earlier build (e.g. a generation) is cached too.
+        Changing e.g. the outer PATH invalidates the cache."""
+        cache_path = path / "env-vars.json"
+        store_path = str((path / "result").resolve())
+        outer_env = dict(os.environ) if outer_env is None else outer_env
+        cache: dict[str, typing.Any]
+        try:
+            cache = json.loads(cache_path.read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            cache = {}
+        entry = cache.get(store_path)
+        if (
+            isinstance(entry, dict)
+            and entry["pkg"] == pkg
+            and all(outer_env.get(key) == value for key, value in entry["outer_env"].items())
+        ):
+            return typing.cast(typing.Mapping[str, str], entry["env_vars"])
         # Direnv uses `nix print-dev-env --profile <profile_path> --json <flake path>`
         # to set their shells set up
         # https://github.com/direnv/direnv/blob/4da566cee14dbd8e75f3cd04622e5983c02a0c1c/stdlib.sh#L1274k
         # Unfortunately, that method gets many unrelated environment variables, like TMP and TEMP set to random things
         # We will simply call env in a subshell
         script = "import os, json; print(json.dumps(dict(os.environ)))"
-        inner_env = json.loads(subprocess.run(
+        inner_env = json.loads(tracing.run(
             ["nix", "shell", pkg, "--command", sys.executable, "-c", script],
             cwd=str(path),
+            env=outer_env,
             check=True,
             text=True,
             capture_output=True,
         ).stdout)
-        outer_env = dict(os.environ)
-        return {
+        env_vars = {
             key: value
             for key, value in inner_env.items()
-            if outer_env[key] != value
+            if outer_env.get(key) != value
         }
+        # Most recently used last
+        cache.pop(store_path, None)
+        cache[store_path] = {
+            "pkg": pkg,
+            "outer_env": {key: outer_env.get(key) for key in env_vars},
+            "env_vars": env_vars,
+        }
+        write_atomic(cache_path, json.dumps(dict(list(cache.items())[-ENV_VARS_CACHE_SIZE:])))
+        return env_vars
 
     @staticmethod
     def lock(path: pathlib.Path) -> None:
-        subprocess.run(
+        tracing.run(
             ["nix", "flake", "lock"],
             cwd=str(path),
             check=True,
@@ -406,24 +1293,167 @@ class NixFlake:
         )
 
     @staticmethod
-    def get_rev(path: pathlib.Path, source_alias: str) -> str:
-        NixFlake.lock(path)
-        return json.loads((path / "flake.lock").read_text())["nodes"][source_alias]["locked"]["rev"]
+    def locked_revs(path: pathlib.Path) -> dict[str, str]:
+        """The rev that `flake.lock` pins each input of the flake to (empty if it has not been locked)"""
+        try:
+            lock = json.loads((path / "flake.lock").read_text())
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+        nodes = lock["nodes"]
+        return {
+            alias: nodes[node]["locked"]["rev"]
+            for alias, node in nodes[lock["root"]].get("inputs", {}).items()
+            # Inputs that follow another input's input are lists
+            if isinstance(node, str) and "rev" in nodes[node].get("locked", {})
+        }
 
     @staticmethod
-    def get_store_path(path: pathlib.Path, pkg: str) -> pathlib.Path:
-        return pathlib.Path(subprocess.run(
-            ["nix", "eval", "--raw", "pkg"],
-            cwd=str(path),
+    def get_store_paths(path: pathlib.Path, pkgs: typing.Sequence[str]) -> dict[str, pathlib.Path | None]:
+        """Evaluates the store paths of many packages of the flake in one `nix eval`.
+
+        Packages that the flake does not (yet) have, or that fail to evaluate (with `throw` or `assert`,
+        which is also how flake.nix.template reports a package name that is not in its source), map to None."""
+        apply = (
+            "packages: builtins.listToAttrs (map"
+            " (name: { inherit name; value = let path = builtins.tryEval (packages.${name}.outPath or null);"
+            " in if path.success then path.value else null; })"
+            f" (builtins.fromJSON {nix_string(json.dumps(list(pkgs)))}))"
+        )
+        store_paths = json.loads(tracing.run(
+            ["nix", "eval", "--json", f"path:{path}#packages.{get_system()}", "--apply", apply],
             capture_output=True,
             text=True,
             check=True,
-        ).stdout.strip())
+        ).stdout)
+        return {
+            pkg: pathlib.Path(store_path) if store_path is not None else None
+            for pkg, store_path in store_paths.items()
+        }
+
+    @staticmethod
+    def attr_names(source: NixSource) -> list[str]:
+        """Names of the top-level packages of the source, without evaluating the packages"""
+        return expect_type(list, json.loads(tracing.run(
+            ["nix", "eval", "--json", f"{source.locked_url}#legacyPackages.{get_system()}", "--apply", "builtins.attrNames"],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout))
+
+    @staticmethod
+    def search(
+            source: NixSource,
+            terms: typing.Sequence[str],
+            limit: int | None = None,
+    ) -> typing.Iterator[NixPackage]:
+        """Search packages in the source with `nix search` (each term is a regex)
+
+        Packages are yielded as soon as Nix prints them.
+        Nix is stopped once `limit` packages are yielded or the caller stops iterating."""
+        import tempfile
+        args = ["nix", "search", source.locked_url, *terms, "--json"]
+        finished = False
+        with tempfile.TemporaryFile() as stderr, tracing.popen(
+                args,
+                stdout=subprocess.PIPE,
+                stderr=stderr,
+                text=True,
+        ) as proc:
+            assert proc.stdout is not None
+            try:
+                for count, (attribute, info) in enumerate(iter_json_object(proc.stdout)):
+                    if limit is not None and count >= limit:
+                        break
+                    yield NixPackage.from_attribute(attribute, source, info["version"], info["description"])
+                else:
+                    finished = True
+            except ValueError as exc:
+                if proc.wait() != 0:
+                    stderr.seek(0)
+                    raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr.read()) from exc
+                raise
+            finally:
+                if not finished:
+                    proc.terminate()
+            if finished and proc.wait() != 0:
+                stderr.seek(0)
+                raise subprocess.CalledProcessError(proc.returncode, args, stderr=stderr.read())
+
+    @staticmethod
+    def closure(paths: typing.Sequence[pathlib.Path]) -> dict[pathlib.Path, int]:
+        """The store paths in the closure of `paths` and their sizes (in bytes)"""
+        infos = json.loads(tracing.run(
+            ["nix", "path-info", "--recursive", "--json", *map(str, paths)],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout)
+        # Nix >= 2.19 prints an object keyed by store path; older versions print a list
+        if isinstance(infos, dict):
+            return {pathlib.Path(path): info["narSize"] for path, info in infos.items()}
+        return {pathlib.Path(info["path"]): info["narSize"] for info in infos}
+
+    @staticmethod
+    def delete(paths: typing.Sequence[pathlib.Path]) -> None:
+        """Deletes the store paths, except those that are still alive"""
+        if not paths:
+            return
+        try:
+            tracing.run(
+                ["nix", "store", "delete", *map(str, paths)],
+                check=True,
+                capture_output=True,
+            )
+        except subprocess.CalledProcessError:
+            # Nix refuses the whole batch if any path is alive, so fall back to deleting them one by one
+            # (repeatedly, since a path can only be deleted after the paths that refer to it)
+            remaining = list(paths)
+            while remaining:
+                for path in remaining:
+                    tracing.run(["nix", "store", "delete", str(path)], check=False, capture_output=True)
+                deleted = [path for path in remaining if not path.exists()]
+                if not deleted:
+                    break
+                remaining = [path for path in remaining if path.exists()]
+
+    @staticmethod
+    def registry_add(registry: pathlib.Path, alias: str, url: str) -> None:
+        """Pin `alias` to `url` in the flake registry file `registry` (creating it if needed)"""
+        tracing.run(
+            ["nix", "registry", "add", "--registry", str(registry), alias, url],
+            check=True,
+            capture_output=True,
+        )
+
+    @staticmethod
+    def build_many(pkgs: typing.Sequence[str]) -> list[pathlib.Path]:
+        """Builds many installables in one `nix build` (which shares the evaluation of common inputs,
+        and schedules all of their derivations together); returns their store paths, in order.
+
+        Nothing is linked to the results, so they are only kept until the next garbage collection."""
+        results = json.loads(tracing.run(
+            ["nix", "build", "--no-link", "--json", "--keep-going", *pkgs],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout)
+        return [pathlib.Path(result["outputs"]["out"]) for result in results]
+
+    @staticmethod
+    def resolve_rev(url: str) -> str:
+        """The rev that the flake URL currently points to"""
+        metadata = json.loads(tracing.run(
+            ["nix", "flake", "metadata", "--json", url],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout)
+        return expect_type(str, metadata["locked"]["rev"])
 
     @staticmethod
-    def build(path: pathlib.Path, pkg: str) -> None:
-        subprocess.run(
-            ["nix", "build", pkg],
+    def build(path: pathlib.Path, pkg: str, out_link: pathlib.Path | None = None) -> None:
+        tracing.run(
+            ["nix", "build", pkg, *(["--out-link", str(out_link)] if out_link is not None else [])],
             cwd=str(path),
             capture_output=True,
             check=True,
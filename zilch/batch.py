@@ -0,0 +1,167 @@
+"""Syncing many projects at once, for `zilch sync --all DIR...` (e.g. every directory of a monorepo).
+
+Compared to syncing each project in turn, this
+- looks up the rev of each distinct unlocked source URL once, rather than once per project,
+- locks the flake of each distinct set of sources once, and gives the other projects with those sources a copy,
+- writes and locks the projects' flakes concurrently (at most `MAX_NIX_JOBS` at a time),
+- builds every environment in one `nix build`, which evaluates shared inputs once and schedules all builds together.
+
+A project that fails (with a ZilchError or a failed Nix call) does not stop the others.
+If the shared build fails, each project is built on its own, to find out which ones fail."""
+from __future__ import annotations
+
+import pathlib
+import subprocess
+import typing
+
+from . import tracing
+from .api import (
+    MAX_NIX_JOBS,
+    NixFlake,
+    ProjectLock,
+    ZilchError,
+    ZilchProject,
+    write_atomic,
+)
+
+if typing.TYPE_CHECKING:
+    import concurrent.futures
+
+# Called with a project's zilch.toml path and what is happening to it
+Progress = typing.Callable[[pathlib.Path, str], None]
+
+# Failures of one project; anything else is a bug, and stops the batch
+ProjectErrors = (ZilchError, subprocess.CalledProcessError)
+
+
+def sync_all(
+        toml_paths: typing.Iterable[pathlib.Path],
+        progress: Progress = lambda toml_path, message: None,
+) -> dict[pathlib.Path, Exception | None]:
+    """Syncs every project; returns the error of each project that failed (None for those that did not)"""
+    import concurrent.futures
+    import contextlib
+    # Sorted, so that concurrent batches take the locks in the same order
+    toml_paths = sorted({ZilchProject.find_toml_path(toml_path) for toml_path in toml_paths})
+    errors: dict[pathlib.Path, Exception | None] = {toml_path: None for toml_path in toml_paths}
+    projects: dict[pathlib.Path, ZilchProject] = {}
+
+    def fail(toml_path: pathlib.Path, exc: Exception) -> None:
+        errors[toml_path] = exc
+        projects.pop(toml_path, None)
+        progress(toml_path, f"failed: {exc}")
+
+    with contextlib.ExitStack() as stack, concurrent.futures.ThreadPoolExecutor(max_workers=MAX_NIX_JOBS) as executor:
+        def each(
+                step: typing.Callable[[pathlib.Path, ZilchProject], typing.Any],
+                toml_paths: typing.Iterable[pathlib.Path] | None = None,
+        ) -> dict[pathlib.Path, typing.Any]:
+            """Runs the step on every remaining project (of `toml_paths`, if given) in the pool;
+            returns the results of those that succeed"""
+            futures = {
+                toml_path: executor.submit(step, toml_path, projects[toml_path])
+                for toml_path in (projects if toml_paths is None else toml_paths)
+                if toml_path in projects
+            }
+            results = {}
+            for toml_path, future in futures.items():
+                try:
+                    results[toml_path] = future.result()
+                except ProjectErrors as exc:
+                    fail(toml_path, exc)
+            return results
+
+        for toml_path in toml_paths:
+            try:
+                stack.enter_context(ProjectLock.for_project(toml_path).acquire(shared=False))
+                projects[toml_path] = ZilchProject.from_path(toml_path, lock_new_sources=False)
+            except ProjectErrors as exc:
+                fail(toml_path, exc)
+
+        with tracing.phase("resolve sources"):
+            _resolve_sources(projects, executor, fail, progress)
+
+        def prepare(toml_path: pathlib.Path, project: ZilchProject) -> str | None:
+            progress(toml_path, "writing flake")
+            project._lock_new_sources()
+            return project._prepare_sync()
+        # The first project of each set of sources locks its flake; the others copy its flake.nix and flake.lock,
+        # which depend only on the sources, so that their `_prepare_sync` finds them locked already
+        groups = _group_by_sources(projects)
+        fingerprints = each(prepare, [group[0] for group in groups])
+        for group in groups:
+            if group[0] in projects:
+                _copy_lock(projects[group[0]], [projects[toml_path] for toml_path in group[1:]])
+        fingerprints.update(each(prepare, [toml_path for group in groups for toml_path in group[1:]]))
+        for toml_path, fingerprint in fingerprints.items():
+            if fingerprint is None:
+                progress(toml_path, "up-to-date")
+                del projects[toml_path]
+        if not projects:
+            return errors
+
+        for toml_path in projects:
+            progress(toml_path, "building")
+        try:
+            built = NixFlake.build_many([project.flake_ref for project in projects.values()])
+            store_paths = {toml_path: str(store_path) for toml_path, store_path in zip(projects, built)}
+        except ProjectErrors:
+            # Build each on its own (from its flake) to tell which ones fail
+            store_paths = {toml_path: project.flake_ref for toml_path, project in projects.items()}
+
+        def build(toml_path: pathlib.Path, project: ZilchProject) -> None:
+            # Cheap when the shared build succeeded: the store path is built, and only needs a generation to keep it
+            project._build_generation(fingerprints[toml_path], store_paths[toml_path])
+            progress(toml_path, "done")
+        each(build)
+    return errors
+
+
+def _resolve_sources(
+        projects: dict[pathlib.Path, ZilchProject],
+        executor: concurrent.futures.Executor,
+        fail: typing.Callable[[pathlib.Path, Exception], None],
+        progress: Progress,
+) -> None:
+    """Gives every pending source without a rev the rev of its URL, looking up each URL once"""
+    urls = {
+        source.url
+        for project in projects.values()
+        for source in project._new_sources
+        if source.rev is None
+    }
+    futures = {url: executor.submit(NixFlake.resolve_rev, url) for url in sorted(urls)}
+    for toml_path, project in list(projects.items()):
+        pending = [source for source in project._new_sources if source.rev is None]
+        try:
+            for source in pending:
+                source.rev = futures[source.url].result()
+        except ProjectErrors as exc:
+            fail(toml_path, exc)
+        else:
+            if pending:
+                progress(toml_path, "resolved sources")
+
+
+def _group_by_sources(projects: dict[pathlib.Path, ZilchProject]) -> list[list[pathlib.Path]]:
+    """The projects, grouped by their sources (in order, with revs and follows); call once every source has a rev"""
+    groups: dict[typing.Any, list[pathlib.Path]] = {}
+    for toml_path, project in projects.items():
+        key = tuple(
+            (source.alias, source.url, source.rev, tuple(sorted(source.follows.items())))
+            for source in project.sources.values()
+        )
+        groups.setdefault(key, []).append(toml_path)
+    return list(groups.values())
+
+
+def _copy_lock(project: ZilchProject, others: list[ZilchProject]) -> None:
+    """Gives the other projects (which have the same sources) the project's flake.nix and flake.lock"""
+    try:
+        files = {name: (project.flake_path / name).read_text() for name in ["flake.nix", "flake.lock"]}
+    except FileNotFoundError:
+        return
+    for other in others:
+        other.flake_path.mkdir(exist_ok=True, parents=True)
+        for name, text in files.items():
+            write_atomic(other.flake_path / name, text)
@@ -1,16 +1,15 @@
+from __future__ import annotations
 import pathlib
 import rich_click as click
-import subprocess
-import json
-import os
 import sys
 import functools
+import typing
 from dataclasses import dataclass
-from rich.table import Table
-from rich.padding import Padding
 
-from .api import NixPackage, NixSource, ZilchProject, ZilchError
-from console import console
+# Everything else (zilch.api, tomlkit, rich.table, the console, ...) is imported in the commands that use it,
+# so that `zilch --help` and `zilch shell` only pay for what they need (see tests/test_startup.py).
+if typing.TYPE_CHECKING:
+    from .api import NixSource, ProjectLock, ZilchProject
 
 SOURCE = "nixpkgs"
 INDENT = 2
@@ -19,61 +18,157 @@ def show_zilch_err(func):
     """Decorator to catch and print ZilchError instead of showing traceback"""
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
+        from .api import ZilchError
         try:
             func(*args, **kwargs)
         except ZilchError as e:
+            from console import console
             console.print(f'[red]Error[/red]: {str(e)}')
             sys.exit(1)
     return wrapper
 
+def write_json(obj: typing.Any) -> None:
+    """Write one compact JSON object per line (NDJSON), bypassing Rich"""
+    import json
+    sys.stdout.write(json.dumps(obj, separators=(",", ":")) + "\n")
+
 @dataclass
 class Context:
+    """Global options; the project is only loaded when a command first needs it"""
     verbose: bool
     path: pathlib.Path
-    project: ZilchProject
-    source: NixSource
+    source_alias: str | None
+    # Write NDJSON instead of Rich output
+    json: bool
+    # Held until the command exits
+    lock: ProjectLock
+
+    @functools.cached_property
+    def project(self) -> ZilchProject:
+        """The project, for commands that modify or sync it (under an exclusive lock)"""
+        from .api import ZilchProject
+        # (Re-)read after getting the lock, in case another process changed the project in the meantime
+        self.lock.acquire(shared=False)
+        return ZilchProject.from_path(self.path)
+
+    @functools.cached_property
+    def read_only_project(self) -> ZilchProject:
+        """The project, for commands that only read it (under a shared lock; never writes the TOML or flake)"""
+        from .api import ZilchProject
+        if self._loaded_project is not None:
+            return self._loaded_project
+        self.lock.acquire(shared=True)
+        return ZilchProject.from_path(self.path, read_only=True)
+
+    @property
+    def _loaded_project(self) -> ZilchProject | None:
+        # cached_property stores its value in the instance dict
+        return self.__dict__.get("project") or self.__dict__.get("read_only_project")
+
+    def query(self, name: str, **args: typing.Any) -> typing.Any:
+        """Runs a read-only query (see zilch.daemon) in the daemon if one is listening, otherwise in this process
+
+        Iterator results (e.g. of search) are streamed either way."""
+        from . import daemon
+        try:
+            return daemon.request(name, self.path, **args)
+        except daemon.Unavailable:
+            return daemon.QUERIES[name](self.read_only_project, **args)
+
+    @property
+    def source(self) -> NixSource | None:
+        """The --source, if given"""
+        if self.source_alias is None:
+            return None
+        project = self._loaded_project or self.read_only_project
+        if self.source_alias not in project.sources:
+            from .api import ZilchError
+            raise ZilchError(f"No source named {self.source_alias} in {project.toml_path}")
+        return project.sources[self.source_alias]
+
+    @property
+    def source_or_default(self) -> NixSource:
+        """The --source, or the default source if none was given"""
+        project = self._loaded_project or self.read_only_project
+        return self.source if self.source is not None else project.sources[SOURCE]
 
 @click.group(no_args_is_help=True)
 @click.help_option("--help", "-h")
 @click.option('--verbose', default=True, is_flag=True)
-@click.option('--source', default="nixpkgs")
+@click.option('--source', default=None, help=f"Source alias. Search defaults to every source; other commands to {SOURCE}")
 @click.option(
     "--path",
     type=pathlib.Path,
     default=None,
     help="path/to/dir containing zilch.toml or path/to/zilch.toml. Defaults to $ZILCH_PATH or $XDG_CONFIG_HOME (or platform equivalent)",
 )
+@click.option(
+    "--profile",
+    type=pathlib.Path,
+    default=None,
+    help="Write the time taken by each Nix call and slow step to this JSON file, and a Chrome trace to PROFILE.trace.json",
+)
+@click.option(
+    "--json",
+    "--ndjson",
+    "output_json",
+    flag_value=True,
+    default=None,
+    help="Write one JSON object per line (per package for search, info and list). The default when stdout is not a terminal",
+)
+@click.option("--text", "output_json", flag_value=False, help="Write text for people, even when stdout is not a terminal")
 @click.pass_context
-def cli(ctx: click.Context, verbose: bool, source: str, path: pathlib.Path) -> None:
-    project = ZilchProject.from_path(path)
+def cli(
+        ctx: click.Context,
+        verbose: bool,
+        source: str | None,
+        path: pathlib.Path,
+        profile: pathlib.Path | None,
+        output_json: bool | None,
+) -> None:
+    if profile is not None:
+        from . import tracing
+        tracing.enable()
+        ctx.call_on_close(functools.partial(tracing.write_report, profile))
+    from .api import ProjectLock, ZilchProject
+    toml_path = ZilchProject.find_toml_path(path)
     ctx.obj = Context(
         verbose,
-        path,
-        project,
-        project.sources[source] if source is not None else None
+        toml_path,
+        source,
+        not sys.stdout.isatty() if output_json is None else output_json,
+        ProjectLock.for_project(toml_path),
     )
+    ctx.call_on_close(ctx.obj.lock.release)
     if ctx.obj.verbose:
-        print("Using zilch.toml from", ctx.obj.project.toml_path)
+        print("Using zilch.toml from", ctx.obj.path, file=sys.stderr if ctx.obj.json else sys.stdout)
 
 @cli.command(no_args_is_help=True)  # @cli, not @click!
 @click.help_option("--help", "-h")
 @click.argument('terms', nargs=-1)
+@click.option('--limit', type=int, default=None, help="Show at most this many packages per source")
 @click.pass_obj
-def search(ctx: Context, terms: list[str]) -> None:
-    sources = ctx.project.sources.values() if ctx.source is None else [ctx.source]
-    for source in sources:
-        console.rule(f"[yellow]{source.alias}")
-        o = subprocess.run(
-            ['nix', 'search', source.url, *terms, '--json'],
-            capture_output=True,
-            check=True
-        )
-        for k, v in json.loads(o.stdout).items():
-            p = NixPackage(k, source, v['version'], v['description'])
-            console.print(f"[green]{p.name}[/green] ({p.version})")
-            if p.description != '':
-                console.print(Padding.indent(f"{p.description}", INDENT))
-            console.print('')
+@show_zilch_err
+def search(ctx: Context, terms: list[str], limit: int | None) -> None:
+    # Every source when no --source is given; each result is printed as soon as it is found
+    results = ctx.query("search", terms=list(terms), limit=limit, source=ctx.source_alias)
+    if ctx.json:
+        for _source, p in results:
+            if p is not None:
+                write_json(p)
+                sys.stdout.flush()
+        return
+    from rich.padding import Padding
+
+    from console import console
+    for source, p in results:
+        if p is None:
+            console.rule(f"[yellow]{source}")
+            continue
+        console.print(f"[green]{p['name']}[/green] ({p['version']})")
+        if p['description'] != '':
+            console.print(Padding.indent(f"{p['description']}", INDENT))
+        console.print('')
 
 
 @cli.command(no_args_is_help=True)  # @cli, not @click!
@@ -88,40 +183,123 @@ def search(ctx: Context, terms: list[str]) -> None:
     ),
 )
 @click.pass_obj
+@show_zilch_err
 def info(ctx: Context, term: str, any_source: bool) -> None:
-    for p in ctx.project.packages:
-        if p.name == term and (p.source is None or any_source or p.source == ctx.source):
-            console.print(f"[green]{p.name}[/green]")
-            t = Table(show_lines=False, show_header=False, box=None, pad_edge=False)
-            t.add_column()
-            t.add_column()
-            t.add_row('description:', p.description)
-            t.add_row('version:', p.version)
-            t.add_row('attribute:', p.attribute)
-            t.add_row('source:', p.source.alias)
-            console.print(Padding.indent(t, INDENT))
-            break
-    else:
+    p = ctx.query("info", term=term, any_source=any_source, source=ctx.source_alias or SOURCE)
+    if p is None:
+        from .api import ZilchError
         raise ZilchError(f'No package {term} is installed')
+    if ctx.json:
+        write_json(p)
+        return
+    from rich.padding import Padding
+    from rich.table import Table
+
+    from console import console
+    console.print(f"[green]{p['name']}[/green]")
+    t = Table(show_lines=False, show_header=False, box=None, pad_edge=False)
+    t.add_column()
+    t.add_column()
+    t.add_row('description:', p['description'])
+    t.add_row('version:', p['version'])
+    t.add_row('attribute:', p['attribute'])
+    t.add_row('source:', p['source'])
+    console.print(Padding.indent(t, INDENT))
+
+
+@cli.command(name="list")  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.pass_obj
+@show_zilch_err
+def list_(ctx: Context) -> None:
+    packages = ctx.query("list", source=ctx.source_alias)
+    if ctx.json:
+        for p in packages:
+            write_json(p)
+        return
+    from rich.table import Table
+
+    from console import console
+    t = Table(show_lines=False, box=None, pad_edge=False)
+    t.add_column('package')
+    t.add_column('source')
+    t.add_column('installed')
+    for p in packages:
+        t.add_row(f"[green]{p['name']}[/green]", p['source'], 'yes' if p['installed'] else '[red]no[/red]')
+    console.print(t)
 
 
 @cli.command(no_args_is_help=True)  # @cli, not @click!
 @click.help_option("--help", "-h")
 @click.argument('packages', nargs=-1)
 @click.pass_obj
+@show_zilch_err
 def install(ctx: Context, packages: list[str]) -> None:
-    for package in packages:
-        ctx.project.add_package(
-            NixPackage.from_name(package, ctx.source)
-        )
-    ctx.project.sync()
+    """Install packages; NAME==VERSION installs the package from an older rev of the source that has that version,
+    replacing any other version of it"""
+    from .api import NixPackage
+    with ctx.project.transaction() as project:
+        for package in packages:
+            name, _, version = package.partition("==")
+            nix_package = NixPackage.from_name(name, ctx.source_or_default)
+            project.check_package(nix_package)
+            if version:
+                nix_package = project.pin_version(nix_package, version)
+            project.add_package(nix_package, replace=bool(version))
 
-@cli.command(no_args_is_help=True)  # @cli, not @click!
+@cli.command()  # @cli, not @click!
 @click.help_option("--help", "-h")
+@click.option(
+    "--all",
+    "all_",
+    is_flag=True,
+    help="Sync the projects in DIRS (each a path/to/dir containing zilch.toml or path/to/zilch.toml) instead, sharing their source lookups and build",
+)
+@click.argument('dirs', nargs=-1, type=click.Path(exists=True, path_type=pathlib.Path))
+@click.pass_obj
+@show_zilch_err
+def sync(ctx: Context, all_: bool, dirs: list[pathlib.Path]) -> None:
+    from console import console
+
+    from .api import ZilchError
+    if not all_:
+        if dirs:
+            raise ZilchError("Pass --all to sync the projects in DIRS")
+        ctx.project.sync()
+        return
+    from . import batch
+
+    def progress(toml_path: pathlib.Path, message: str) -> None:
+        console.print(f"[yellow]{toml_path.parent}[/yellow]: {message}")
+
+    errors = batch.sync_all(dirs, progress)
+    failed = [toml_path for toml_path, error in errors.items() if error is not None]
+    console.print(f"Synced {len(errors) - len(failed)} of {len(errors)} projects")
+    if failed:
+        raise ZilchError(f"Could not sync {', '.join(str(toml_path.parent) for toml_path in failed)}")
+
+@cli.command()  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.option("--dry-run", is_flag=True, help="Only show what would be removed")
+@click.option("--newer", is_flag=True, help="Also remove the generations after the current one (e.g. after a rollback)")
 @click.pass_obj
-def autoremove(ctx: Context) -> None:
-    ctx.project.sync()
-    ctx.project.autoremove()
+@show_zilch_err
+def autoremove(ctx: Context, dry_run: bool, newer: bool) -> None:
+    from rich.filesize import decimal
+
+    from console import console
+    if dry_run:
+        # From the current state: a dry run changes nothing, so it does not sync either
+        paths, size = ctx.read_only_project.autoremove(dry_run=True, newer=newer)
+    else:
+        ctx.project.sync()
+        paths, size = ctx.project.autoremove(newer=newer)
+    if dry_run:
+        for path in paths:
+            console.print(path)
+        console.print(f"Would remove up to {len(paths)} store paths ({decimal(size)})")
+    else:
+        console.print(f"Removed {len(paths)} store paths ({decimal(size)})")
 
 @cli.command(no_args_is_help=True)  # @cli, not @click!
 @click.help_option("--help", "-h")
@@ -136,21 +314,96 @@ def autoremove(ctx: Context) -> None:
 @click.argument('packages', nargs=-1)
 @click.help_option("--help", "-h")
 @click.pass_obj
+@show_zilch_err
 def uninstall(ctx: Context, any_source: bool, packages: list[str]) -> None:
-    for package in packages:
-        ctx.project.remove_package(
-            NixPackage.from_name(package, ctx.source),
-            any_source=any_source,
+    from .api import NixPackage
+    with ctx.project.transaction() as project:
+        for package in packages:
+            project.remove_package(
+                NixPackage.from_name(package, ctx.source_or_default),
+                any_source=any_source,
+            )
+
+@cli.command()  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.pass_obj
+@show_zilch_err
+def generations(ctx: Context) -> None:
+    import datetime
+
+    from rich.table import Table
+
+    from console import console
+    project = ctx.read_only_project
+    current = project.current_generation()
+    t = Table(show_lines=False, box=None, pad_edge=False)
+    t.add_column('generation')
+    t.add_column('built')
+    for generation in project.generations():
+        built = datetime.datetime.fromtimestamp(project.generation_path(generation).stat().st_mtime)
+        t.add_row(
+            f"[green]{generation}[/green] (current)" if generation == current else str(generation),
+            built.strftime("%Y-%m-%d %H:%M:%S"),
         )
-    ctx.project.sync()
+    console.print(t)
+
+@cli.command()  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.pass_obj
+@show_zilch_err
+def rollback(ctx: Context) -> None:
+    from console import console
+    generation = ctx.project.rollback()
+    console.print(f"Switched to generation {generation}")
+
+@cli.command(name="switch-generation", no_args_is_help=True)  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.argument('generation', type=int)
+@click.pass_obj
+@show_zilch_err
+def switch_generation(ctx: Context, generation: int) -> None:
+    from console import console
+    ctx.project.switch_generation(generation)
+    console.print(f"Switched to generation {generation}")
+
+@cli.command()  # @cli, not @click!
+@click.help_option("--help", "-h")
+@click.pass_obj
+@show_zilch_err
+def daemon(ctx: Context) -> None:
+    """Answer search, info, list and shell queries of every project from memory, until interrupted.
+
+    Listens on $ZILCH_DAEMON_SOCKET, or daemon.sock in the user's data directory.
+    Other Zilch commands use the daemon when it is running."""
+    from console import console
+
+    from . import daemon as daemon_
+    path = daemon_.socket_path()
+    with daemon_.Daemon().server(path) as server:
+        console.print(f"Listening on {path}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            path.unlink(missing_ok=True)
 
 @cli.command(no_args_is_help=True)  # @cli, not @click!
 @click.help_option("--help", "-h")
 @click.argument('cmd', nargs=-1)
 @click.pass_context # need the whole Click context to run ctx.exit(...)
+@show_zilch_err
 def shell(ctx: click.Context, cmd: list[str]) -> None:
-    ctx.obj.project.sync()
-    env_vars = ctx.obj.project.get_env_vars()
+    import os
+    import subprocess
+    # Shells of an up-to-date project only need a shared lock (or the daemon), so they can start concurrently
+    env_vars = ctx.obj.query("env", environ=dict(os.environ))
+    if env_vars is None:
+        project = ctx.obj.project
+        project.sync()
+        env_vars = project.get_env_vars()
+    # The environment only refers to the store, so the command itself does not hold up other Zilch processes
+    ctx.obj.lock.release()
     proc = subprocess.run(
         cmd,
         env={**os.environ, **env_vars},
@@ -0,0 +1,281 @@
+"""An optional long-lived Zilch process (`zilch daemon`) that answers read-only queries over a Unix socket.
+
+It keeps every project it was asked about loaded, reloading one when its zilch.toml changes,
+along with everything else cached in the process (e.g. the system, see `get_system`),
+so that e.g. `zilch list` neither parses the TOML nor starts Nix.
+The CLI sends its queries (see `QUERIES`) to the daemon when one is listening, and otherwise runs them in-process.
+
+Each connection carries one request, a JSON object on one line, and its response, one or more such lines:
+the result of the query, or one line per item of queries that produce their result bit by bit (e.g. search),
+as soon as each item is produced.
+Only the user's own processes may connect, since queries run Nix with the client's environment:
+the socket is only accessible to the user (wherever $ZILCH_DAEMON_SOCKET puts it),
+and connections from other users are dropped where the OS tells who connected (SO_PEERCRED)."""
+from __future__ import annotations
+
+import collections.abc
+import contextlib
+import json
+import os
+import pathlib
+import socket
+import threading
+import typing
+
+from . import api
+
+if typing.TYPE_CHECKING:
+    import socketserver
+
+    from .api import NixPackage, NixSource, ZilchProject
+
+# Bump when requests or responses change, so that an old daemon is not asked what it cannot answer
+PROTOCOL = 2
+
+
+class Unavailable(Exception):
+    """No daemon is listening"""
+
+
+def socket_path() -> pathlib.Path:
+    if "ZILCH_DAEMON_SOCKET" in os.environ:
+        return pathlib.Path(os.environ["ZILCH_DAEMON_SOCKET"])
+    return api.DEFAULT_DATA_PATH / "daemon.sock"
+
+
+def package_json(package: NixPackage, **extra: typing.Any) -> dict[str, typing.Any]:
+    """The fields of a package in query results (and --json output)"""
+    return {
+        "name": package.name,
+        "source": package.source.alias,
+        "version": package.version,
+        "description": package.description,
+        "attribute": package.attribute,
+        **extra,
+    }
+
+
+def _source(project: ZilchProject, alias: str | None) -> NixSource | None:
+    if alias is None:
+        return None
+    if alias not in project.sources:
+        raise api.ZilchError(f"No source named {alias} in {project.toml_path}")
+    return project.sources[alias]
+
+
+# Queries take a read-only project and JSON arguments, and return JSON or an iterator of JSON items
+
+def query_list(project: ZilchProject, source: str | None) -> list[dict[str, typing.Any]]:
+    nix_source = _source(project, source)
+    packages = [
+        p for p in project.packages.values()
+        if nix_source is None or p.source == nix_source
+    ]
+    return [package_json(p, installed=installed) for p, installed in zip(packages, project.installed(packages))]
+
+
+def query_info(project: ZilchProject, term: str, any_source: bool, source: str) -> dict[str, typing.Any] | None:
+    """The added package named `term` (from `source` unless `any_source`), if any"""
+    nix_source = _source(project, source)
+    for p in project.packages.values():
+        if p.name == term and (any_source or p.source == nix_source):
+            return package_json(p)
+    return None
+
+
+def query_search(
+        project: ZilchProject,
+        terms: list[str],
+        limit: int | None,
+        source: str | None,
+) -> typing.Iterator[tuple[str, dict[str, typing.Any] | None]]:
+    """(source alias, package) of every result, as soon as it is found
+
+    Each source starts with (source alias, None), so that sources without results are still reported.
+    Sources are searched concurrently when there are several, and come one after the other as each is done."""
+    nix_source = _source(project, source)
+    if nix_source is None:
+        for searched, packages in project.search_many(project.sources.values(), terms, limit):
+            yield searched.alias, None
+            for p in packages:
+                yield searched.alias, package_json(p)
+    else:
+        yield nix_source.alias, None
+        for p in project.search(nix_source, terms, limit):
+            yield nix_source.alias, package_json(p)
+
+
+def query_env(project: ZilchProject, environ: dict[str, str]) -> dict[str, str] | None:
+    """The variables to set in `environ` to enter the project's environment, or None if the project needs a sync"""
+    if not project.is_synced():
+        return None
+    return dict(project.get_env_vars(environ))
+
+
+QUERIES: dict[str, typing.Callable[..., typing.Any]] = {
+    "list": query_list,
+    "info": query_info,
+    "search": query_search,
+    "env": query_env,
+}
+
+
+def request(query: str, toml_path: pathlib.Path, **args: typing.Any) -> typing.Any:
+    """Runs a query on the project in the daemon
+
+    Queries that produce an iterator (see `QUERIES`) return one that yields each item as the daemon sends it.
+
+    Raises:
+        Unavailable: no daemon is listening (only then should the query run elsewhere)
+        ZilchError: the query failed, or the daemon did not answer it
+    """
+    path = socket_path()
+    with contextlib.ExitStack() as stack:
+        sock = stack.enter_context(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        try:
+            sock.connect(str(path))
+        except (ConnectionRefusedError, FileNotFoundError, PermissionError) as exc:
+            # PermissionError: e.g. another user's daemon
+            raise Unavailable() from exc
+        # Sent without a buffered writer, which would try again to send the request when closed after a failure
+        stream = stack.enter_context(sock.makefile("r"))
+        try:
+            sock.sendall((json.dumps({
+                "protocol": PROTOCOL,
+                "query": query,
+                "path": str(toml_path),
+                "args": args,
+            }) + "\n").encode())
+            response = _read_response(path, stream)
+        except (BrokenPipeError, ConnectionResetError) as exc:
+            # E.g. the daemon refused the connection (see `_same_user`)
+            raise api.ZilchError(f"The daemon on {path} closed the connection without answering") from exc
+        if "result" in response:
+            return response["result"]
+        # The iterator closes the connection once it is exhausted (or garbage collected)
+        return _items(path, stream, response, stack.pop_all())
+
+
+def _read_response(path: pathlib.Path, stream: typing.TextIO) -> dict[str, typing.Any]:
+    line = stream.readline()
+    if not line:
+        raise api.ZilchError(f"The daemon on {path} closed the connection without answering")
+    response = json.loads(line)
+    if response.get("protocol") != PROTOCOL:
+        raise api.ZilchError(
+            f"The daemon on {path} speaks protocol {response.get('protocol')}, not {PROTOCOL}; restart it"
+        )
+    if "error" in response:
+        if response.get("type") == "ZilchError":
+            raise api.ZilchError(response["error"])
+        raise api.ZilchError(f"The daemon failed with {response.get('type')}: {response['error']}")
+    return response
+
+
+def _items(
+        path: pathlib.Path,
+        stream: typing.TextIO,
+        response: dict[str, typing.Any],
+        connection: contextlib.ExitStack,
+) -> typing.Iterator[typing.Any]:
+    with connection:
+        while "end" not in response:
+            yield response["item"]
+            response = _read_response(path, stream)
+
+
+def _same_user(sock: socket.socket) -> bool:
+    """Whether the peer of a connection runs as this user (True where the OS cannot tell; the socket's mode still applies)"""
+    if not hasattr(socket, "SO_PEERCRED"):
+        return True
+    import struct
+    _pid, uid, _gid = struct.unpack("3i", sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize("3i")))
+    return uid == os.getuid()
+
+
+class Daemon:
+    """The state of a running daemon: the projects it has loaded"""
+
+    def __init__(self) -> None:
+        # Keyed by the stat of the zilch.toml, or None if there is none (yet)
+        self._projects: dict[pathlib.Path, tuple[tuple[int, int, int] | None, ZilchProject]] = {}
+        self._projects_lock = threading.Lock()
+
+    def project(self, toml_path: pathlib.Path) -> ZilchProject:
+        """The project, (re-)loaded if its zilch.toml changed since it was last loaded; call under its shared lock"""
+        try:
+            stat = toml_path.stat()
+        except FileNotFoundError:
+            # Loaded as an empty zilch.toml, as in-process read-only commands do
+            key = None
+        else:
+            key = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        with self._projects_lock:
+            loaded = self._projects.get(toml_path)
+            if loaded is not None and loaded[0] == key:
+                return loaded[1]
+        project = api.ZilchProject.from_path(toml_path, read_only=True)
+        with self._projects_lock:
+            self._projects[toml_path] = (key, project)
+        return project
+
+    def handle(self, request: dict[str, typing.Any]) -> typing.Generator[dict[str, typing.Any], None, None]:
+        """The lines of the response to the request, each as soon as it is ready
+
+        Every error, whether a ZilchError or not, is sent to the client (rather than dropping the connection),
+        so that the client does not mistake it for the daemon being unavailable."""
+        try:
+            if request.get("protocol") != PROTOCOL:
+                raise api.ZilchError(f"The request is for protocol {request.get('protocol')}, not {PROTOCOL}")
+            if request.get("query") not in QUERIES:
+                raise api.ZilchError(f"Unknown query {request.get('query')}")
+            toml_path = pathlib.Path(request["path"])
+            with api.ProjectLock.for_project(toml_path).acquire(shared=True):
+                result = QUERIES[request["query"]](self.project(toml_path), **request["args"])
+                if not isinstance(result, collections.abc.Iterator):
+                    yield {"protocol": PROTOCOL, "result": result}
+                    return
+                for item in result:
+                    yield {"protocol": PROTOCOL, "item": item}
+                yield {"protocol": PROTOCOL, "end": True}
+        except api.ZilchError as exc:
+            yield {"protocol": PROTOCOL, "error": str(exc), "type": type(exc).__name__}
+        except Exception as exc:
+            # A bug (or e.g. a failed Nix call): keep the traceback in the daemon's log
+            import logging
+            logging.getLogger(__name__).exception("Failed to answer %s", request)
+            yield {"protocol": PROTOCOL, "error": str(exc), "type": type(exc).__name__}
+
+    def server(self, path: pathlib.Path) -> socketserver.UnixStreamServer:
+        """A server on the socket at `path`, replacing a stale socket; call `serve_forever` on it"""
+        import socketserver
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self) -> None:
+                if not _same_user(self.request):
+                    return
+                line = self.rfile.readline()
+                if not line:
+                    return
+                # Closing the responses stops the query (and releases its lock) when the client hangs up early
+                with contextlib.closing(daemon.handle(json.loads(line))) as responses:
+                    for response in responses:
+                        try:
+                            self.wfile.write((json.dumps(response) + "\n").encode())
+                        except (BrokenPipeError, ConnectionResetError):
+                            return
+
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                sock.connect(str(path))
+        except (ConnectionRefusedError, FileNotFoundError):
+            path.unlink(missing_ok=True)
+        else:
+            raise api.ZilchError(f"A daemon is already listening on {path}")
+        path.parent.mkdir(exist_ok=True, parents=True)
+        server = socketserver.ThreadingUnixStreamServer(str(path), Handler)
+        server.daemon_threads = True
+        # Whatever the umask allowed; connections in between are still checked by `_same_user`
+        os.chmod(path, 0o600)
+        return server
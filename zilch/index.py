@@ -0,0 +1,232 @@
+from __future__ import annotations
+
+import contextlib
+import os
+import pathlib
+import re
+import sqlite3
+import typing
+
+from . import tracing
+
+if typing.TYPE_CHECKING:
+    from .api import NixPackage, NixSource
+
+
+# Characters that make a search term a regex (as `nix search` interprets it) rather than a literal
+REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+# bm25 weights of the name, attribute, version, and description columns
+WEIGHTS = (10.0, 5.0, 1.0, 2.0)
+
+
+def _replace_index(tmp_path: pathlib.Path, db_path: pathlib.Path) -> None:
+    """Moves a newly built index (named `{alias}-{rev}.sqlite`) into place and removes those of other revs"""
+    os.replace(tmp_path, db_path)
+    alias = db_path.stem.rpartition("-")[0]
+    for stale in db_path.parent.glob(f"{alias}-*.sqlite"):
+        if stale != db_path and stale.stem.rpartition("-")[0] == alias:
+            stale.unlink(missing_ok=True)
+
+
+@contextlib.contextmanager
+def _new_index(db_path: pathlib.Path) -> typing.Iterator[sqlite3.Connection]:
+    """A connection to a new database, which replaces the index at `db_path` (see `_replace_index`) if the block succeeds.
+
+    The database is a temporary file of its own next to the index, so that concurrent builds
+    (e.g. by the daemon's threads) do not overwrite each other's, and readers never see a partial index."""
+    import tempfile
+    db_path.parent.mkdir(exist_ok=True, parents=True)
+    fd, name = tempfile.mkstemp(dir=db_path.parent, prefix=f".{db_path.name}.")
+    os.close(fd)
+    tmp_path = pathlib.Path(name)
+    try:
+        with sqlite3.connect(tmp_path) as conn:
+            yield conn
+        conn.close()
+        _replace_index(tmp_path, db_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _connect_read_only(db_path: pathlib.Path) -> sqlite3.Connection:
+    # as_uri escapes the % in resource paths like .../zilch/%2Fhome%2Fuser%2Fproject
+    return sqlite3.connect(f"{db_path.absolute().as_uri()}?mode=ro", uri=True)
+
+
+def edit_distance(a: str, b: str, max_distance: int | None = None) -> int:
+    """Levenshtein distance between two strings
+
+    If it is more than `max_distance`, any number more than `max_distance` may be returned (which is much faster)."""
+    if max_distance is not None and abs(len(a) - len(b)) > max_distance:
+        return max_distance + 1
+    previous = list(range(len(b) + 1))
+    for i, char_a in enumerate(a, 1):
+        current = [i]
+        for j, char_b in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (char_a != char_b)))
+        if max_distance is not None and min(current) > max_distance:
+            return max_distance + 1
+        previous = current
+    return previous[-1]
+
+
+def _regexp(pattern: str, value: str | None) -> bool:
+    return value is not None and re.search(pattern, value, re.IGNORECASE) is not None
+
+
+class SearchIndex:
+    """Full-text index over every package of one source at one locked revision.
+
+    This is a SQLite FTS5 table with a trigram tokenizer, so any substring of 3+ characters is matched in
+    the name, attribute, version or description, like `nix search` does.
+    Shorter terms and regexes fall back to a scan of the table, which is still far cheaper than evaluating
+    the source again."""
+
+    def __init__(self, db_path: pathlib.Path) -> None:
+        self.db_path = db_path
+
+    @staticmethod
+    def for_source(resource_path: pathlib.Path, source: NixSource) -> SearchIndex:
+        assert source.rev is not None
+        return SearchIndex(resource_path / "search" / f"{source.alias}-{source.rev}.sqlite")
+
+    def exists(self) -> bool:
+        return self.db_path.exists()
+
+    def build(self, packages: typing.Iterable[NixPackage]) -> None:
+        """Builds the index from every package of the source.
+
+        The index is written to a temporary file and renamed into place, so readers never see a partial index.
+        Indexes of other revisions of the same source are removed."""
+        with _new_index(self.db_path) as conn:
+            conn.execute(
+                "CREATE VIRTUAL TABLE packages USING fts5("
+                "name, attribute, version, description, tokenize = 'trigram')"
+            )
+            conn.executemany(
+                "INSERT INTO packages VALUES (?, ?, ?, ?)",
+                (
+                    (package.name, package.attribute, package.version or "", package.description or "")
+                    for package in packages
+                ),
+            )
+
+    def search(
+            self,
+            source: NixSource,
+            terms: typing.Sequence[str],
+            limit: int | None = None,
+    ) -> typing.Iterator[NixPackage]:
+        """Yields packages matching every term, best match first."""
+        from .api import NixPackage
+
+        match_terms = [term for term in terms if len(term) >= 3 and not REGEX_CHARS & set(term)]
+        other_terms = [term for term in terms if term not in match_terms]
+
+        conditions = []
+        params: list[str] = []
+        if match_terms:
+            conditions.append("packages MATCH ?")
+            params.append(" AND ".join('"' + term.replace('"', '""') + '"' for term in match_terms))
+        for term in other_terms:
+            pattern = term if REGEX_CHARS & set(term) else re.escape(term)
+            conditions.append("(attribute REGEXP ? OR description REGEXP ?)")
+            params.extend([pattern, pattern])
+        # Exact name matches first, then by relevance, then shorter names first
+        order = [f"lower(name) IN ({', '.join('?' * len(terms))}) DESC"] if terms else []
+        if match_terms:
+            order.append(f"bm25(packages, {', '.join(map(str, WEIGHTS))})")
+        order.extend(["length(name)", "name"])
+        params.extend(term.lower() for term in terms)
+        query = (
+            "SELECT name, attribute, version, description FROM packages"
+            + (" WHERE " + " AND ".join(conditions) if conditions else "")
+            + " ORDER BY " + ", ".join(order)
+            + (f" LIMIT {int(limit)}" if limit is not None else "")
+        )
+
+        conn = _connect_read_only(self.db_path)
+        conn.create_function("REGEXP", 2, _regexp, deterministic=True)
+        try:
+            # Executing the statement runs the query up to the first row (all of it, when sorting);
+            # the rest is read as the caller consumes the results
+            with tracing.phase("query search index", source=source.alias):
+                rows = conn.execute(query, params)
+            for _name, attribute, version, description in rows:
+                yield NixPackage.from_attribute(attribute, source, version, description)
+        finally:
+            conn.close()
+
+
+class NameIndex:
+    """The top-level package names of one source at one locked revision, for checking names and suggesting others.
+
+    The names are stored once in a plain table (for exact lookups)
+    and indexed by an external-content FTS5 trigram table over it (for suggestions),
+    so that a suggestion only compares the names that share a trigram with the misspelling."""
+
+    # Candidates (by number of shared trigrams) whose edit distance is computed
+    CANDIDATES = 200
+
+    def __init__(self, db_path: pathlib.Path) -> None:
+        self.db_path = db_path
+
+    @staticmethod
+    def for_source(resource_path: pathlib.Path, source: NixSource) -> NameIndex:
+        assert source.rev is not None
+        return NameIndex(resource_path / "names" / f"{source.alias}-{source.rev}.sqlite")
+
+    def exists(self) -> bool:
+        return self.db_path.exists()
+
+    def build(self, names: typing.Iterable[str]) -> None:
+        """Builds the index, replacing those of other revisions of the same source (like `SearchIndex.build`)."""
+        with _new_index(self.db_path) as conn:
+            conn.execute("CREATE TABLE names (name TEXT UNIQUE)")
+            conn.execute(
+                "CREATE VIRTUAL TABLE name_trigrams USING fts5("
+                "name, content = 'names', tokenize = 'trigram')"
+            )
+            conn.executemany("INSERT INTO names VALUES (?)", ((name,) for name in names))
+            conn.execute("INSERT INTO name_trigrams (rowid, name) SELECT rowid, name FROM names")
+
+    def __contains__(self, name: str) -> bool:
+        conn = _connect_read_only(self.db_path)
+        try:
+            return conn.execute("SELECT 1 FROM names WHERE name = ?", (name,)).fetchone() is not None
+        finally:
+            conn.close()
+
+    def suggest(self, name: str, limit: int = 3) -> list[str]:
+        """The closest names by edit distance (at most a third of the name's length, but at least 2)
+
+        Candidates are the names sharing the most trigrams with `name`.
+        Typos in short names can leave no trigram intact (hlelo); then names of about the same length
+        and with the same first letter are compared instead."""
+        max_distance = max(2, len(name) // 3)
+        trigrams = {name[i:i + 3].lower() for i in range(len(name) - 2)}
+        conn = _connect_read_only(self.db_path)
+        try:
+            suggestions = []
+            if trigrams:
+                suggestions = self._closest(name, max_distance, (row[0] for row in conn.execute(
+                    f"SELECT name FROM name_trigrams WHERE name_trigrams MATCH ? ORDER BY rank LIMIT {self.CANDIDATES}",
+                    (" OR ".join('"' + trigram.replace('"', '""') + '"' for trigram in trigrams),),
+                )))
+            if not suggestions:
+                suggestions = self._closest(name, max_distance, (row[0] for row in conn.execute(
+                    "SELECT name FROM names WHERE length(name) BETWEEN ? AND ? AND lower(substr(name, 1, 1)) = ?",
+                    (len(name) - max_distance, len(name) + max_distance, name[:1].lower()),
+                )))
+        finally:
+            conn.close()
+        return suggestions[:limit]
+
+    @staticmethod
+    def _closest(name: str, max_distance: int, candidates: typing.Iterable[str]) -> list[str]:
+        distances = {candidate: edit_distance(name.lower(), candidate.lower(), max_distance) for candidate in candidates}
+        return sorted(
+            (candidate for candidate, distance in distances.items() if distance <= max_distance),
+            key=lambda candidate: (distances[candidate], candidate),
+        )
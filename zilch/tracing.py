@@ -0,0 +1,148 @@
+"""Timing of Nix invocations and slow Python-side phases, for `zilch --profile`.
+
+Every process Zilch starts (Nix, or e.g. Git) should go through `run` or `popen`, and slow Python-side work through `phase`.
+These are no-ops (besides running the process) until `enable` is called."""
+from __future__ import annotations
+
+import contextlib
+import dataclasses
+import json
+import os
+import pathlib
+import subprocess
+import threading
+import time
+import typing
+
+
+@dataclasses.dataclass
+class Event:
+    name: str
+    category: str
+    start: float
+    duration: float
+    thread: int
+    args: dict[str, typing.Any]
+
+
+_events: list[Event] | None = None
+_origin = time.perf_counter()
+
+
+def enable() -> None:
+    global _events, _origin
+    _events = []
+    _origin = time.perf_counter()
+
+
+def _record(name: str, category: str, start: float, args: dict[str, typing.Any]) -> None:
+    if _events is not None:
+        _events.append(Event(
+            name,
+            category,
+            start - _origin,
+            time.perf_counter() - start,
+            threading.get_native_id(),
+            args,
+        ))
+
+
+def _name(args: typing.Sequence[str]) -> str:
+    """The subcommand, e.g. `nix build` or `nix flake lock`"""
+    return " ".join(args[:3] if args[1:2] in (["flake"], ["store"]) else args[:2])
+
+
+def _output_size(*outputs: str | bytes | None) -> int | None:
+    if all(output is None for output in outputs):
+        return None
+    return sum(len(output) for output in outputs if output is not None)
+
+
+@contextlib.contextmanager
+def phase(name: str, **args: typing.Any) -> typing.Iterator[None]:
+    """Time a Python-side phase, e.g. parsing the TOML"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _record(name, "python", start, args)
+
+
+def run(args: typing.Sequence[str], *, check: bool, **kwargs: typing.Any) -> subprocess.CompletedProcess[typing.Any]:
+    """`subprocess.run`, recording the argv, cwd, duration, exit status, and output size
+
+    Raises:
+        CalledProcessError: the process failed, if `check`
+    """
+    start = time.perf_counter()
+    info = {"argv": list(args), "cwd": str(kwargs.get("cwd") or os.getcwd())}
+    proc = subprocess.run(args, check=False, **kwargs)
+    _record(_name(args), "nix", start, {
+        **info,
+        "returncode": proc.returncode,
+        "output_size": _output_size(proc.stdout, proc.stderr),
+    })
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, args, proc.stdout, proc.stderr)
+    return proc
+
+
+@contextlib.contextmanager
+def popen(args: typing.Sequence[str], **kwargs: typing.Any) -> typing.Iterator[subprocess.Popen[typing.Any]]:
+    """`subprocess.Popen` as a context manager, recording like `run` once the process exits
+
+    The output size is not known, since the caller consumes the output."""
+    start = time.perf_counter()
+    info = {"argv": list(args), "cwd": str(kwargs.get("cwd") or os.getcwd())}
+    proc = subprocess.Popen(args, **kwargs)
+    try:
+        with proc:
+            yield proc
+    finally:
+        _record(_name(args), "nix", start, {**info, "returncode": proc.returncode})
+
+
+def write_report(path: pathlib.Path) -> None:
+    """Write a JSON summary to `path` and a Chrome trace (for chrome://tracing or Perfetto) next to it"""
+    events = _events or []
+    total = time.perf_counter() - _origin
+    nix_events = [event for event in events if event.category == "nix"]
+    summary = {
+        "total_seconds": total,
+        "nix_calls": len(nix_events),
+        "nix_seconds": sum(event.duration for event in nix_events),
+        "phases": {
+            name: {
+                "count": len(durations),
+                "seconds": sum(durations),
+            }
+            for name, durations in _group_durations(events).items()
+        },
+        "events": [dataclasses.asdict(event) for event in events],
+    }
+    path.write_text(json.dumps(summary, indent=2))
+    pid = os.getpid()
+    trace = {
+        "traceEvents": [
+            {
+                "name": event.name,
+                "cat": event.category,
+                "ph": "X",
+                "ts": event.start * 1e6,
+                "dur": event.duration * 1e6,
+                "pid": pid,
+                "tid": event.thread,
+                "args": event.args,
+            }
+            for event in events
+        ],
+        "displayTimeUnit": "ms",
+    }
+    path.with_suffix(".trace.json").write_text(json.dumps(trace))
+
+
+def _group_durations(events: list[Event]) -> dict[str, list[float]]:
+    groups: dict[str, list[float]] = {}
+    for event in events:
+        groups.setdefault(event.name, []).append(event.duration)
+    return groups
@@ -0,0 +1,244 @@
+"""Finding the rev of a source at which a package has a given version, for `zilch install name==version`.
+
+Only commits that touch the package's file (e.g. pkgs/by-name/he/hello/package.nix) can change its version,
+so those are the candidates, listed from a blobless Git mirror of the source.
+Versions are assumed to only increase along the history, so the candidates are binary searched,
+evaluating the package's version at O(log n) of them.
+Each (rev, attribute) evaluation is kept in an on-disk cache shared by every project,
+so repeated and overlapping searches (e.g. for another version of the same package) mostly skip Nix."""
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import pathlib
+import re
+import sqlite3
+import subprocess
+import typing
+
+from . import tracing
+
+if typing.TYPE_CHECKING:
+    from .api import NixPackage, NixSource
+
+
+def split_version(version: str) -> list[str]:
+    """Components of a version like Nix's `builtins.splitVersion`: runs of digits or of other characters, split at . and -"""
+    return re.findall(r"\d+|[^\d.\-]+", version)
+
+
+def _component_lt(c1: str, c2: str) -> bool:
+    """Component order of Nix's `builtins.compareVersions`"""
+    if c1.isdigit() and c2.isdigit():
+        return int(c1) < int(c2)
+    elif (c1 == "" and c2.isdigit()) or (c1 == "pre" and c2 != "pre"):
+        return True
+    elif c2 == "pre" or c1.isdigit():
+        return False
+    elif c2.isdigit():
+        return True
+    else:
+        return c1 < c2
+
+
+def compare_versions(v1: str, v2: str) -> int:
+    """-1, 0, or 1 as v1 is older than, the same as, or newer than v2, like Nix's `builtins.compareVersions`"""
+    components1 = split_version(v1)
+    components2 = split_version(v2)
+    for i in range(max(len(components1), len(components2))):
+        c1 = components1[i] if i < len(components1) else ""
+        c2 = components2[i] if i < len(components2) else ""
+        if _component_lt(c1, c2):
+            return -1
+        elif _component_lt(c2, c1):
+            return 1
+    return 0
+
+
+def git_remote(url: str) -> str:
+    """The Git repository of a flake URL; only GitHub, GitLab, and git+ URLs have one"""
+    from .api import ZilchError
+    if match := re.match(r"(github|gitlab):([^/?]+)/([^/?]+)", url):
+        host, owner, repo = match.groups()
+        return f"https://{host}.com/{owner}/{repo}.git"
+    elif url.startswith("git+"):
+        return url[len("git+"):].partition("?")[0]
+    raise ZilchError(f"Cannot find versions in {url}: Only GitHub, GitLab, and git+ sources have a history to search")
+
+
+class VersionCache:
+    """Version and defining file of packages at revs, evaluated once and kept across projects.
+
+    Only successful evaluations are kept, as failures may be transient (e.g. a network error).
+    Use it as a context manager (or call `close`) to close the database."""
+
+    def __init__(self, db_path: pathlib.Path) -> None:
+        self.db_path = db_path
+        self.db_path.parent.mkdir(exist_ok=True, parents=True)
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS versions ("
+                "rev TEXT, attribute TEXT, version TEXT, position TEXT, PRIMARY KEY (rev, attribute))"
+            )
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def __enter__(self) -> VersionCache:
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+    @staticmethod
+    def default() -> VersionCache:
+        from . import api
+        return VersionCache(api.DEFAULT_CACHE_PATH / "versions.sqlite")
+
+    def get(self, rev: str, attribute: str) -> tuple[str | None, str | None] | None:
+        """(version, position) of the attribute at the rev, or None if it was not evaluated yet"""
+        row = self.conn.execute(
+            "SELECT version, position FROM versions WHERE rev = ? AND attribute = ?",
+            (rev, attribute),
+        ).fetchone()
+        return None if row is None else (row[0], row[1])
+
+    def put(self, rev: str, attribute: str, version: str | None, position: str | None) -> None:
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO versions VALUES (?, ?, ?, ?)",
+                (rev, attribute, version, position),
+            )
+
+
+# How Nix reports that the rev has no such package, or is from before the source became a flake
+_MISSING = re.compile(r"attribute '[^']*' missing|does not provide attribute|does not contain a 'flake\.nix'")
+
+
+def evaluate(source: NixSource, attribute: str, cache: VersionCache) -> tuple[str | None, str | None]:
+    """(version, file:line) of the attribute in the source at its rev; (None, None) if the rev does not have it
+
+    Revs from before a source became a flake, or before the package existed, do not have it.
+
+    Raises:
+        ZilchError: the evaluation failed otherwise (e.g. a network or evaluation error),
+            which says nothing about the package's version at the rev
+    """
+    assert source.rev is not None
+    cached = cache.get(source.rev, attribute)
+    if cached is not None:
+        return cached
+    apply = "p: { version = p.version or null; position = p.meta.position or null; }"
+    try:
+        result = json.loads(tracing.run(
+            ["nix", "eval", "--json", f"{source.locked_url}#{attribute}", "--apply", apply],
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout)
+    except subprocess.CalledProcessError as exc:
+        if _MISSING.search(exc.stderr or ""):
+            return (None, None)
+        from .api import ZilchError
+        raise ZilchError(
+            f"Cannot evaluate {attribute} of {source.alias} at {source.rev}: {(exc.stderr or '').strip()}"
+        ) from exc
+    cache.put(source.rev, attribute, result["version"], result["position"])
+    return (result["version"], result["position"])
+
+
+def package_file(position: str) -> str:
+    """The path within the source of a `meta.position` like /nix/store/...-source/pkgs/hello/default.nix:12"""
+    match = re.match(r"/nix/store/[^/]+/(.+):\d+$", position)
+    if not match:
+        from .api import ZilchError
+        raise ZilchError(f"Cannot find the file of a package defined at {position}")
+    return match.group(1)
+
+
+def git_mirror(url: str, rev: str) -> pathlib.Path:
+    """A blobless bare clone of the source's repository that has `rev`, in the cache
+
+    Blobless clones have every commit and tree (what `git log -- <path>` needs), but fetch file contents on demand."""
+    from . import api
+    remote = git_remote(url)
+    mirror = api.DEFAULT_CACHE_PATH / "git" / hashlib.sha256(remote.encode()).hexdigest()[:32]
+    if not mirror.exists():
+        mirror.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = mirror.with_name(f".{mirror.name}.{os.getpid()}")
+        tracing.run(
+            ["git", "clone", "--quiet", "--bare", "--filter=blob:none", remote, str(tmp_path)],
+            check=True,
+            capture_output=True,
+        )
+        os.replace(tmp_path, mirror)
+    # Exits nonzero if the mirror does not have the commit (yet)
+    has_rev = tracing.run(
+        ["git", "-C", str(mirror), "cat-file", "-e", f"{rev}^{{commit}}"],
+        check=False,
+        capture_output=True,
+    ).returncode == 0
+    if not has_rev:
+        tracing.run(
+            ["git", "-C", str(mirror), "fetch", "--quiet", "--filter=blob:none", "origin", rev],
+            check=True,
+            capture_output=True,
+        )
+    return mirror
+
+
+def commits_touching(mirror: pathlib.Path, rev: str, path: str) -> list[str]:
+    """Commits up to `rev` that change the file at `path`, newest first, following renames"""
+    return tracing.run(
+        ["git", "-C", str(mirror), "log", "--follow", "--format=%H", rev, "--", path],
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+
+
+def find_rev(package: NixPackage, version: str, cache: VersionCache | None = None) -> str:
+    """The newest rev of the package's source (up to the source's rev) at which the package has `version`"""
+    import dataclasses
+
+    from .api import ZilchError
+    source = package.source
+    if source.rev is None:
+        raise ZilchError(f"Cannot find versions of {package.name}: {source.alias} is not locked")
+    if cache is None:
+        with VersionCache.default() as cache:
+            return find_rev(package, version, cache)
+
+    def version_at(rev: str) -> str | None:
+        return evaluate(dataclasses.replace(source, rev=rev), package.attribute, cache)[0]
+
+    current, position = evaluate(source, package.attribute, cache)
+    if current is None or position is None:
+        raise ZilchError(f"Cannot find versions of {package.name}: It has no version or position in {source.alias}")
+    if compare_versions(current, version) == 0:
+        return source.rev
+    elif compare_versions(current, version) < 0:
+        raise ZilchError(f"Cannot install {package.name}=={version}: {source.alias} only has up to {current}")
+    with tracing.phase("list package commits", package=package.name):
+        mirror = git_mirror(source.url, source.rev)
+        commits = commits_touching(mirror, source.rev, package_file(position))
+    # Find the newest commit at which the version is at most `version`.
+    # Commits that do not have the package are taken to be older than every version.
+    lo, hi = 0, len(commits)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        mid_version = version_at(commits[mid])
+        if mid_version is not None and compare_versions(mid_version, version) > 0:
+            lo = mid + 1
+        else:
+            hi = mid
+    older = version_at(commits[lo]) if lo < len(commits) else None
+    if older is not None and compare_versions(older, version) == 0:
+        return commits[lo]
+    newer = version_at(commits[lo - 1]) if lo > 0 else current
+    raise ZilchError(
+        f"Cannot install {package.name}=={version}: {source.alias} has no such version"
+        f" (the closest are {older or 'none'} and {newer})"
+    )